@@ -0,0 +1,5 @@
+"""
+Performance benchmarks for the Just Mercy text application
+
+Run from the repository root with `python -m benchmarks.run` - see README.md
+"""
@@ -0,0 +1,71 @@
+#!/bin/python3
+
+"""
+Synthetic message history
+
+Fills an in-memory transport (utils.transport.RecordingTransport or
+SimulatedTransport) with past texts, so the log pages and message sync have
+an account's worth of history to read back
+"""
+
+import random
+from datetime import datetime, timedelta, timezone
+
+
+##########
+
+
+def seed_history(
+    transport,
+    number: str,
+    count: int,
+    days: int = 90,
+    reply_rate: float = 0.2,
+    undelivered_rate: float = 0.02,
+    seed: int = 0,
+):
+    """
+    This function records count past messages on transport, oldest first:
+    mostly outgoing reminders, some replies, and a few undelivered texts
+
+    Parameters
+        transport: RecordingTransport | Where the history is stored
+        number: str | Our Twilio phone number
+        count: int | Messages to add
+        days: int | History is spread evenly over this many days
+        reply_rate: float | Fraction of messages that are participant replies
+        undelivered_rate: float | Fraction of outgoing texts that bounced
+        seed: int | Random seed, so runs are reproducible
+    """
+
+    rng = random.Random(seed)
+    start = datetime.now(timezone.utc) - timedelta(days=days)
+    step = timedelta(days=days) / max(count, 1)
+
+    with transport.lock:
+        for ix in range(count):
+            participant = f"+1650{ix % 10_000_000:07d}"
+            when = start + step * ix
+
+            if rng.random() < reply_rate:
+                transport.record(
+                    to=number,
+                    from_=participant,
+                    body="Thanks, see you then",
+                    direction="inbound",
+                    status="received",
+                    when=when,
+                )
+                continue
+
+            undelivered = rng.random() < undelivered_rate
+
+            transport.record(
+                to=participant,
+                from_=number,
+                body="Reminder: your study session is coming up",
+                direction="outbound-api",
+                status="undelivered" if undelivered else "delivered",
+                when=when,
+                error_code=30003 if undelivered else None,
+            )
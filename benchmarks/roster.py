@@ -0,0 +1,161 @@
+#!/bin/python3
+
+"""
+Synthetic participant rosters
+
+Builds upload files shaped like the ones the study team sends us: subject
+names, phone numbers in the mix of formats people actually type, and study
+dates spread around today the way recruitment happens - a steady trickle of
+enrollment plus a few busy recruitment waves
+"""
+
+import numpy as np
+import pandas as pd
+from datetime import date
+
+
+##########
+
+
+FIRST_NAMES = [
+    "ian",
+    "sydney",
+    "jamil",
+    "maria",
+    "daniel",
+    "sam",
+    "aisha",
+    "chen",
+    "fatima",
+    "jose",
+    "keisha",
+    "liam",
+    "mohammed",
+    "nora",
+    "omar",
+    "priya",
+]
+
+LAST_NAMES = [
+    "ferguson",
+    "garcia",
+    "johnson",
+    "kim",
+    "lopez",
+    "nguyen",
+    "okafor",
+    "patel",
+    "robinson",
+    "smith",
+    "tran",
+    "washington",
+    "williams",
+    "zhang",
+]
+
+# How often each phone number format shows up in a roster
+PHONE_FORMATS = {
+    "6502235997": 0.4,
+    "(650) 223-5997": 0.25,
+    "650-223-5997": 0.2,
+    "+16502235997": 0.15,
+}
+
+
+def synthetic_roster(
+    size: int,
+    today: date = None,
+    seed: int = 0,
+    past_days: int = 120,
+    future_days: int = 30,
+    waves: int = 4,
+    wave_share: float = 0.35,
+    missing_rate: float = 0.005,
+    cohorts: list = None,
+):
+    """
+    This function generates a roster of size participants with unique
+    (name, phone number) pairs
+
+    Parameters
+        size: int | Number of participants
+        today: date | Dates are spread around this day (defaults to today)
+        seed: int | Random seed, so runs are reproducible
+        past_days: int | Earliest study date, in days before today
+        future_days: int | Latest study date, in days after today
+        waves: int | Number of recruitment waves
+        wave_share: float | Fraction of participants enrolled during a wave
+        missing_rate: float | Fraction of rows with no phone number
+        cohorts: list | Cohort names to assign (omits the column if None)
+
+    Returns
+        DataFrame with subject_name, phone_number and date_of_study columns
+    """
+
+    rng = np.random.default_rng(seed)
+    today = today or date.today()
+
+    # -- Study dates: uniform enrollment plus normally-distributed waves
+    offsets = rng.integers(-past_days, future_days + 1, size=size)
+
+    in_wave = rng.random(size) < wave_share
+    centers = rng.integers(-past_days, future_days + 1, size=waves)
+    wave_offsets = rng.choice(centers, size=size) + rng.normal(0, 4, size=size)
+    offsets = np.where(in_wave, np.round(wave_offsets), offsets)
+    offsets = np.clip(offsets, -past_days, future_days).astype(int)
+
+    # Only a few hundred distinct dates - format each once
+    days, position = np.unique(offsets, return_inverse=True)
+    labels = pd.Timestamp(today) + pd.to_timedelta(days, unit="D")
+    labels = labels.strftime("%m/%d/%Y")
+    study_dates = np.asarray(labels, dtype=object)[position]
+
+    # -- Names: common first / last names, made unique with a numeric suffix
+    first = rng.choice(FIRST_NAMES, size=size)
+    last = rng.choice(LAST_NAMES, size=size)
+    names = pd.Series(first).str.cat(
+        [pd.Series(last), pd.Series(np.arange(size).astype(str))], sep=" "
+    )
+
+    # -- Phone numbers: unique 7-digit suffixes in a handful of formats
+    suffixes = rng.choice(10_000_000, size=size, replace=False)
+    area = rng.choice(["650", "415", "408", "510"], size=size)
+    exchange = pd.Series((suffixes // 10_000).astype(str)).str.zfill(3)
+    line = pd.Series((suffixes % 10_000).astype(str)).str.zfill(4)
+
+    area = pd.Series(area)
+    plain = area + exchange + line
+
+    variants = [
+        plain,
+        "(" + area + ") " + exchange + "-" + line,
+        area + "-" + exchange + "-" + line,
+        "+1" + plain,
+    ]
+
+    formats = rng.choice(len(PHONE_FORMATS), size=size, p=list(PHONE_FORMATS.values()))
+    phones = pd.Series(np.select([formats == ix for ix in range(4)], variants, None))
+    phones[rng.random(size) < missing_rate] = None
+
+    roster = pd.DataFrame(
+        {
+            "subject_name": names,
+            "phone_number": phones,
+            "date_of_study": study_dates,
+        }
+    )
+
+    if cohorts:
+        roster["cohort"] = rng.choice(cohorts, size=size)
+
+    return roster
+
+
+def write_roster(roster, path: str):
+    """
+    Saves a roster as the CSV an operator would upload
+    """
+
+    roster.to_csv(path, index=False)
+
+    return path
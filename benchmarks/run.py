@@ -0,0 +1,334 @@
+#!/bin/python3
+
+"""
+BENCHMARK SUITE
+
+Builds a synthetic roster for each size, loads it into a scratch copy of
+jm.db, and times the app's hot paths against the simulated text transport
+(utils.transport.SimulatedTransport) rather than Twilio. Results are written
+as JSON so a release can be compared with the last one
+
+Usage
+    python -m benchmarks.run --sizes 10000 100000 1000000
+    python -m benchmarks.run --compare benchmarks/results/<earlier run>.json
+"""
+
+import argparse, base64, json, os, platform, statistics, subprocess, sys, tempfile
+from datetime import datetime
+from time import perf_counter
+
+from benchmarks.history import seed_history
+from benchmarks.roster import synthetic_roster, write_roster
+from utils.transport import SimulatedTransport
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Stands in for our Twilio number
+NUMBER = "+15550000000"
+
+
+##########
+
+
+class QuietProgress:
+    """
+    Progress sink for send_texts that counts instead of flashing
+    """
+
+    def __init__(self):
+        self.counts = {"total": 0, "sent": 0, "skipped": 0, "failed": 0}
+
+    def start(self, total):
+        self.counts["total"] = total
+
+    def sent(self):
+        self.counts["sent"] += 1
+
+    def skipped(self, message):
+        self.counts["skipped"] += 1
+
+    def failed(self, message):
+        self.counts["failed"] += 1
+
+
+def measure(function, repeat=3, setup=None):
+    """
+    Times function() repeat times, running setup() untimed before each run
+
+    Returns
+        Dictionary of min / median / max seconds and the last return value
+    """
+
+    timings, value = [], None
+
+    for _ in range(repeat):
+
+        if setup is not None:
+            setup()
+
+        started = perf_counter()
+        value = function()
+        timings.append(perf_counter() - started)
+
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "max": max(timings),
+        "runs": repeat,
+    }, value
+
+
+def sandbox(directory, transport):
+    """
+    Points the app at a scratch database in directory and at transport,
+    leaving the real jm.db and Twilio account untouched
+    """
+
+    # main picks its own transport at import, so import it before overriding
+    import main
+    from utils import helper
+    from utils.connection import close_connections
+    from utils.writer import BackgroundWriter
+
+    close_connections()
+    helper.WRITER.close()
+
+    helper.here = ROOT
+    helper.DATABASE = os.path.join(directory, "jm.db")
+    helper.WRITER = BackgroundWriter(helper.DATABASE)
+    helper.TWILIO = ("ACbenchmark", "benchmark", NUMBER, None)
+    helper.use_transport(transport)
+    helper.SCHEDULES = None
+    helper.invalidate_message_cache()
+
+    helper.sql_init()
+
+    return helper
+
+
+def run_size(size, args, results):
+    """
+    Runs every benchmark against a roster of size participants
+    """
+
+    from utils.db import ParseSubjects
+
+    transport = SimulatedTransport(
+        latency=args.latency,
+        jitter=args.latency / 2,
+        failure_rate=args.failure_rate,
+        seed=args.seed,
+    )
+    seed_history(transport, number=NUMBER, count=args.history, seed=args.seed)
+
+    def record(name, timing, rows=None, **extra):
+        entry = {"size": size, "benchmark": name, "seconds": timing, "rows": rows}
+
+        if rows:
+            entry["rows_per_second"] = round(rows / timing["median"], 1)
+
+        entry.update(extra)
+        results.append(entry)
+
+        median = timing["median"] * 1000
+        print(f"{size:>9,} {name:<28} {median:>10.1f} ms  {rows or ''}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        helper = sandbox(directory, transport)
+
+        roster = synthetic_roster(size, seed=args.seed, cohorts=None)
+        path = write_roster(roster, os.path.join(directory, "roster.csv"))
+
+        # -- Roster import: first upload inserts, repeats find every row unchanged
+        timing, counts = measure(lambda: ParseSubjects(directory, path).run(), repeat=1)
+        record("import_roster", timing, rows=size, counts=counts)
+
+        timing, counts = measure(
+            lambda: ParseSubjects(directory, path).run(), repeat=args.repeat
+        )
+        record("reimport_roster", timing, rows=size, counts=counts)
+
+        # -- Reads used by planning and the participant pages
+        timing, frame = measure(helper.db_to_dataframe, repeat=args.repeat)
+        record("db_to_dataframe", timing, rows=len(frame))
+
+        timing, due = measure(helper.db_due_today, repeat=args.repeat)
+        record("db_due_today", timing, rows=len(due))
+
+        timing, plan = measure(lambda: helper.plan_texts(frame), repeat=args.repeat)
+        record("plan_texts", timing, rows=len(plan))
+
+        # -- Sending: contact events and the outbox are cleared between runs
+        def reset_sends():
+            with helper.connect(helper.DATABASE) as connection:
+                connection.execute("DELETE FROM contact_events;")
+                connection.execute("DELETE FROM outbox;")
+
+        def send():
+            progress = QuietProgress()
+            helper.send_texts(
+                dataframe=due.head(args.send_limit),
+                concurrent=True,
+                max_workers=args.workers,
+                per_second=None,
+                progress=progress,
+            )
+            return progress.counts
+
+        timing, counts = measure(send, repeat=args.repeat, setup=reset_sends)
+        record(
+            "send_texts",
+            timing,
+            rows=counts["sent"] + counts["failed"],
+            counts=counts,
+            latency=args.latency,
+            workers=args.workers,
+        )
+
+        # -- Message history straight from the transport
+        timing, texts = measure(
+            lambda: helper.get_texts(sent_by_me=True),
+            repeat=args.repeat,
+            setup=helper.invalidate_message_cache,
+        )
+        record("get_texts", timing, rows=len(texts))
+
+        timing, pulled = measure(lambda: helper.sync_message_log(ttl=0), repeat=1)
+        record("sync_message_log", timing, rows=pulled)
+
+        # -- Log pages through the Flask test client (message mirror already synced)
+        import main
+
+        main.app.config["MESSAGE_CACHE_TTL"] = 3600
+        main.database_ready.set()
+
+        user, password = next(iter(main.user_data.items()))
+        token = base64.b64encode(f"{user}:{password}".encode()).decode()
+        headers = {"Authorization": f"Basic {token}"}
+
+        web = main.app.test_client()
+
+        routes = {
+            "route_participant_log": "/participant_log",
+            "route_participant_log_full": "/participant_log?stream=1",
+            "route_outgoing_texts": "/outgoing_texts",
+            "route_incoming_texts": "/incoming_texts",
+            "route_twilio_errors": "/twilio-errors",
+        }
+
+        for name, url in routes.items():
+
+            def fetch():
+                response = web.get(url, headers=headers)
+                body = response.get_data()
+
+                if response.status_code != 200:
+                    raise RuntimeError(f"{url} returned {response.status_code}")
+
+                return len(body)
+
+            timing, size_bytes = measure(fetch, repeat=args.repeat)
+            record(name, timing, response_bytes=size_bytes)
+
+        from utils.connection import close_connections
+
+        helper.WRITER.close()
+        close_connections()
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+
+    except OSError:
+        return None
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    Prints the change in median time against an earlier results file
+
+    Returns
+        Number of benchmarks that got slower by more than tolerance
+    """
+
+    with open(baseline_path) as incoming:
+        baseline = {
+            (entry["size"], entry["benchmark"]): entry
+            for entry in json.load(incoming)["results"]
+        }
+
+    print(f"\n== Compared with {baseline_path} ==\n")
+
+    regressions = 0
+
+    for entry in results:
+        before = baseline.get((entry["size"], entry["benchmark"]))
+
+        if before is None:
+            continue
+
+        ratio = entry["seconds"]["median"] / max(before["seconds"]["median"], 1e-9)
+        flag = ""
+
+        if ratio > 1 + tolerance:
+            regressions += 1
+            flag = "  ** slower **"
+
+        print(f"{entry['size']:>9,} {entry['benchmark']:<28} {ratio:>6.2f}x{flag}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app's hot paths")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark")
+    parser.add_argument("--latency", type=float, default=0.05, help="Fake send seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.01)
+    parser.add_argument("--workers", type=int, default=8, help="Sends in flight")
+    parser.add_argument("--send-limit", type=int, default=500, help="Texts per run")
+    parser.add_argument("--history", type=int, default=20_000, help="Fake messages")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/)")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown")
+    args = parser.parse_args()
+
+    results = []
+
+    print(f"\n{'size':>9} {'benchmark':<28} {'median':>13}  rows\n")
+
+    for size in args.sizes:
+        run_size(size, args, results)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "options": vars(args),
+        "results": results,
+    }
+
+    output = args.output or os.path.join(
+        ROOT, "benchmarks", "results", f"{datetime.now():%Y%m%d-%H%M%S}.json"
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    with open(output, "w") as outgoing:
+        json.dump(report, outgoing, indent=5)
+
+    print(f"\n** Results saved to {output} **\n")
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,13 +17,21 @@ from flask import (
     redirect,
     url_for,
     flash,
+    abort,
+    jsonify,
+    g,
+    Response,
+    stream_with_context,
 )
 from flask_httpauth import HTTPBasicAuth
-from werkzeug.security import generate_password_hash
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 from utils.helper import *
 from utils.db import ParseSubjects
-import pathlib
+from utils.metrics import REQUEST_SECONDS, render as render_metrics
+from utils.profiling import Profile, profiled
+from time import perf_counter
+import pathlib, threading
 
 
 ##########
@@ -35,16 +43,148 @@ system_path = app.root_path
 app.config["UPLOAD_FOLDER"] = "files/uploads"
 app.config["SECRET_KEY"] = "jamil4ever"
 
+# Twilio throughput limits for /distribute
+app.config["MAX_SENDS_IN_FLIGHT"] = 8
+app.config["MESSAGES_PER_SECOND"] = 1.0
+
+# Rows per page on the log views, and seconds between Twilio syncs
+app.config["LOG_PAGE_SIZE"] = 100
+app.config["MESSAGE_CACHE_TTL"] = 60
+
+# Reject webhook calls that aren't signed by Twilio
+app.config["VALIDATE_TWILIO_SIGNATURES"] = True
+
+# Twilio signs the public https:// URL it calls, but behind a proxy the app
+# sees its own http:// address - trust this many proxies' X-Forwarded-Proto /
+# -Host, or set PUBLIC_URL (e.g., "https://jm.example.org") to sign against
+app.config["PROXY_HOPS"] = int(os.environ.get("JM_PROXY_HOPS", 1))
+app.config["PUBLIC_URL"] = os.environ.get("JM_PUBLIC_URL")
+
+# Where texts go: "twilio", or "simulated" / "recording" to run offline
+app.config["TEXT_TRANSPORT"] = os.environ.get("JM_TRANSPORT", "twilio")
+
+# Profiling - admins add ?profile=1 to a page to profile that request. With
+# PROFILE_SLOWER_THAN set (seconds), every request is profiled and the ones that
+# take longer are kept; cProfile slows Python-heavy requests, so leave it None
+# unless chasing a slow page
+app.config["PROFILE_FOLDER"] = "files/profiles"
+app.config["PROFILE_ADMINS"] = {"Ian"}
+app.config["PROFILE_SLOWER_THAN"] = None
+app.config["PROFILE_COLLAPSED_STACKS"] = False
+
+# One keep-alive connection per send in flight (the transport is built on first use)
+use_transport(app.config["TEXT_TRANSPORT"], pool_size=app.config["MAX_SENDS_IN_FLIGHT"])
+
 if not os.path.exists(os.path.join(system_path, app.config["UPLOAD_FOLDER"])):
     pathlib.Path(os.path.join(system_path, app.config["UPLOAD_FOLDER"])).mkdir(
         parents=True, exist_ok=True
     )
 
+if app.config["PROXY_HOPS"]:
+    hops = app.config["PROXY_HOPS"]
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=hops, x_host=hops)
+
 auth = HTTPBasicAuth()
-very_secret_pw = generate_password_hash("justmercy2022!")
 
-# Build database if it doesn't exist
-sql_init()
+# Build / migrate the database on the first request rather than at import
+database_ready = threading.Event()
+database_lock = threading.Lock()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = perf_counter()
+
+
+@app.after_request
+def record_request_duration(response):
+    started = g.pop("request_started", None)
+
+    if started is not None:
+        # Route patterns rather than raw paths keep the label set small
+        REQUEST_SECONDS.observe(
+            perf_counter() - started,
+            route=request.url_rule.rule if request.url_rule else "unmatched",
+            method=request.method,
+            status=response.status_code,
+        )
+
+    return response
+
+
+def profile_requested():
+    """
+    True if an admin asked for this request to be profiled with ?profile=1
+    """
+
+    credentials = request.authorization
+
+    return (
+        request.args.get("profile") == "1"
+        and credentials is not None
+        and credentials.username in app.config["PROFILE_ADMINS"]
+        and verify(credentials.username, credentials.password)
+    )
+
+
+def profile_folder():
+    return os.path.join(system_path, app.config["PROFILE_FOLDER"])
+
+
+@app.before_request
+def start_profiler():
+    g.profile_requested = profile_requested()
+
+    if not g.profile_requested and app.config["PROFILE_SLOWER_THAN"] is None:
+        return
+
+    profile = Profile(
+        profile_folder(),
+        f"{request.method}-{request.endpoint or 'unmatched'}",
+        collapsed=app.config["PROFILE_COLLAPSED_STACKS"],
+    )
+
+    # Skipped if a profiler is already active (cProfile is process-wide on 3.12+)
+    if profile.start():
+        g.profile = profile
+
+
+@app.after_request
+def save_profile(response):
+    profile = g.pop("profile", None)
+
+    if profile is None:
+        return response
+
+    # Streamed pages are profiled up to the first byte, not the whole body
+    elapsed = profile.stop()
+    threshold = app.config["PROFILE_SLOWER_THAN"]
+
+    if g.profile_requested or (threshold is not None and elapsed >= threshold):
+        response.headers["X-Profile"] = os.path.basename(profile.save())
+
+    return response
+
+
+@app.teardown_request
+def stop_profiler(error):
+    # after_request is skipped when a view raises - don't leave the profiler on
+    profile = g.pop("profile", None)
+
+    if profile is not None:
+        profile.stop()
+
+
+@app.before_request
+def ensure_database():
+    if database_ready.is_set():
+        return
+
+    with database_lock:
+        if not database_ready.is_set():
+            sql_init()
+            database_ready.set()
+
 
 print("\n== App Running ==\n")
 
@@ -99,12 +239,78 @@ def texts():
 
     if request.method == "POST":
 
-        data = db_to_dataframe()
-        send_texts(dataframe=data)
+        # Sends the previewed plan as-is (or plans and sends in one go without one)
+        plan_id = request.form.get("plan_id", type=int)
 
-        return redirect(url_for("index"))
+        # Sending runs on a background thread - /distribute/status reports progress
+        try:
+            job_id = start_distribution(
+                plan_id=plan_id,
+                max_workers=app.config["MAX_SENDS_IN_FLIGHT"],
+                per_second=app.config["MESSAGES_PER_SECOND"],
+                profile=profiled(
+                    profile_folder(),
+                    "distribute-job",
+                    collapsed=app.config["PROFILE_COLLAPSED_STACKS"],
+                )
+                if g.profile_requested
+                else None,
+            )
+            flash(f"Distribution started (job {job_id})")
+
+        except JobAlreadyRunning as e:
+            flash(f"{e} - wait for it to finish before sending again")
+
+        except PlanUnavailable as e:
+            flash(str(e))
 
-    return render_template("texts.html")
+        return redirect(url_for("texts"))
+
+    return render_template("texts.html", job=distribution_status())
+
+
+@app.route("/distribute/plan", methods=["POST"])
+@auth.login_required
+def preview_texts():
+
+    plan_id = build_plan()
+
+    return redirect(url_for("distribution_plan", plan_id=plan_id))
+
+
+@app.route("/distribute/plan/<int:plan_id>", methods=["GET"])
+@auth.login_required
+def distribution_plan(plan_id):
+
+    plan = get_plan(plan_id)
+
+    if plan is None:
+        abort(404)
+
+    return render_template("plan.html", plan=plan)
+
+
+@app.route("/distribute/status", methods=["GET"])
+@app.route("/distribute/status/<int:job_id>", methods=["GET"])
+@auth.login_required
+def distribution_progress(job_id=None):
+
+    job = distribution_status(job_id=job_id)
+
+    if job is None:
+        abort(404)
+
+    return jsonify(job)
+
+
+@app.route("/metrics", methods=["GET"])
+@auth.login_required
+def metrics():
+    """
+    Counters and latency histograms in the Prometheus text format
+    """
+
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
 
 
 ######
@@ -113,29 +319,103 @@ def texts():
 @app.route("/participant_log", methods=["GET", "POST"])
 @auth.login_required
 def participant_log():
-    df = db_to_dataframe()
-    return render_template("logs/stream.html", data=df)
+    return render_log(view="participants", template="logs/stream.html")
 
 
 @app.route("/outgoing_texts", methods=["GET", "POST"])
 @auth.login_required
 def outgoing_texts():
-    data = get_texts(sent_by_me=True)
-    return render_template("logs/outgoing_texts.html", data=data)
+    refresh_message_log()
+    return render_log(view="outgoing", template="logs/outgoing_texts.html")
 
 
 @app.route("/incoming_texts", methods=["GET", "POST"])
 @auth.login_required
 def incoming_texts():
-    data = get_texts(sent_by_me=False)
-    return render_template("logs/incoming_texts.html", data=data)
+    refresh_message_log()
+    return render_log(view="incoming", template="logs/incoming_texts.html")
 
 
 @app.route("/twilio-errors", methods=["GET", "POST"])
 @auth.login_required
 def twilio_error_log():
-    data = get_twilio_errors()
-    return render_template("logs/twilio_errors.html", data=data)
+    refresh_message_log()
+    return render_log(view="errors", template="logs/twilio_errors.html")
+
+
+def render_log(view, template):
+    """
+    Renders one page of a log view, or the whole view as a streamed
+    response when the request includes ?stream=1
+
+    Query parameters: q (search), sort, order (asc / desc), after (cursor)
+    """
+
+    options = {
+        "search": request.args.get("q"),
+        "sort": request.args.get("sort"),
+        "order": request.args.get("order") or LOG_VIEWS[view]["order"],
+        "after": request.args.get("after"),
+    }
+
+    sorts = list(LOG_VIEWS[view]["sort"])
+
+    if request.args.get("stream"):
+        columns, rows = stream_log(view=view, **options)
+
+        return stream_template(
+            template,
+            columns=columns,
+            rows=rows,
+            next_cursor=None,
+            options=options,
+            sorts=sorts,
+        )
+
+    columns, rows, next_cursor = log_page(
+        view=view, per_page=app.config["LOG_PAGE_SIZE"], **options
+    )
+
+    return render_template(
+        template,
+        columns=columns,
+        rows=rows,
+        next_cursor=next_cursor,
+        options=options,
+        sorts=sorts,
+    )
+
+
+def stream_template(template_name, **context):
+    """
+    Streams a template to the browser as it renders, so the first rows
+    arrive before the last rows have been read from the database
+    """
+
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(50)
+
+    return Response(stream_with_context(stream))
+
+
+def refresh_message_log():
+    """
+    Pulls new messages into the local mirror before a log page renders;
+    if Twilio is unreachable we fall back to what's already on disk
+
+    Syncs are shared across log pages for MESSAGE_CACHE_TTL seconds;
+    ?refresh=1 forces a fresh pull
+    """
+
+    if request.args.get("refresh"):
+        invalidate_message_cache()
+
+    try:
+        sync_message_log(ttl=app.config["MESSAGE_CACHE_TTL"])
+
+    except Exception as e:
+        flash(f"Message log may be out of date ... {e}")
 
 
 ######
@@ -149,7 +429,8 @@ def update():
         sub_name = request.form["ignore_name"]
         sub_number = request.form["ignore_number"]
 
-        ignore_participant(full_name=sub_name, contact_number=sub_number)
+        if not ignore_participant(full_name=sub_name, contact_number=sub_number):
+            flash(f"No participant {sub_name} at {sub_number} - nobody was opted out")
 
         return redirect(url_for("index"))
 
@@ -170,10 +451,26 @@ def add_to_db():
 
         # -- Push subjects to database
         # Instantiate ParseSubjects object
-        pusher = ParseSubjects(app_path=system_path, file=file_path)
+        pusher = ParseSubjects(
+            app_path=system_path, file=file_path, cohorts=get_schedules()
+        )
+
+        # Push to database (nothing is saved if any row fails validation)
+        try:
+            counts = pusher.run()
+            message = (
+                f"{counts['inserted']} participants added, "
+                f"{counts['updated']} updated, {counts['unchanged']} unchanged"
+            )
 
-        # Push to database
-        pusher.run()
+            # Same name and number more than once => the last row was kept
+            if counts["duplicates"]:
+                message += f" ({counts['duplicates']} repeated rows skipped)"
+
+            flash(message)
+
+        except ValueError as e:
+            flash(f"Roster was not imported - {e}")
 
         # Remove file
         os.remove(file_path)
@@ -196,7 +493,9 @@ def change_phone_number():
         new_n = request.form["new_number"]
 
         try:
-            update_contact_number(name=name, old_number=old_n, new_number=new_n)
+            if not update_contact_number(name=name, old_number=old_n, new_number=new_n):
+                flash(f"No participant {name} at {old_n} - nothing was changed")
+
             return redirect(url_for("index"))
 
         except Exception as e:
@@ -235,8 +534,13 @@ def nuclear_option():
         value = request.form["confirm"].strip().upper()
 
         if value == "YES":
-            sql_init(destroy=True)
-            flash("DATABASE RESET SUCCESSFULLY")
+            try:
+                sql_init(destroy=True)
+                flash("DATABASE RESET SUCCESSFULLY")
+
+            except JobAlreadyRunning as e:
+                flash(f"DATABASE WAS NOT RESET! {e} - wait for it to finish")
+
             return redirect(url_for("index"))
 
         else:
@@ -253,7 +557,15 @@ def lookup_contact():
         contact = request.form["contact_number"]
         data = easy_lookup(contact_number=contact)
 
-        return render_template("utilities/lookup_result.html", data=data)
+        # Texts each match has been sent, from contact_events
+        history = {
+            participant_id: participant_history(participant_id)
+            for participant_id in data["id"]
+        }
+
+        return render_template(
+            "utilities/lookup_result.html", data=data, history=history
+        )
 
     return render_template("utilities/lookup.html")
 
@@ -266,12 +578,71 @@ def sms():
 
     from twilio.twiml.messaging_response import MessagingResponse
 
+    # Persist the incoming text without holding up the reply - an unsigned
+    # request isn't recorded, but the sender still gets the reply below
+    if (
+        request.method == "POST"
+        and "MessageSid" in request.form
+        and valid_twilio_request()
+    ):
+        record_inbound_text(
+            sid=request.form["MessageSid"],
+            from_=request.form.get("From"),
+            to=request.form.get("To"),
+            body=request.form.get("Body", ""),
+        )
+
     response = MessagingResponse()
     response.message("Give us a call at ‪(650) 223-5997‬ if you have any questions!")
 
     return str(response)
 
 
+@app.route("/sms/status", methods=["POST"])
+def sms_status():
+    """
+    Twilio delivery-status webhook - records each outgoing message's
+    latest status locally, keyed by message SID
+    """
+
+    if not valid_twilio_request():
+        abort(403)
+
+    record_message_status(
+        sid=request.form["MessageSid"],
+        status=request.form["MessageStatus"],
+        error_code=request.form.get("ErrorCode") or None,
+        to=request.form.get("To"),
+        from_=request.form.get("From"),
+    )
+
+    return ("", 204)
+
+
+def valid_twilio_request():
+    """
+    Confirms a webhook was signed with our Twilio auth token
+    """
+
+    if not app.config["VALIDATE_TWILIO_SIGNATURES"]:
+        return True
+
+    from twilio.request_validator import RequestValidator
+
+    validator = RequestValidator(twilio_creds()[1])
+    url = request.url
+
+    if app.config["PUBLIC_URL"]:
+        url = app.config["PUBLIC_URL"].rstrip("/") + request.path
+
+        if request.query_string:
+            url += "?" + request.query_string.decode()
+
+    return validator.validate(
+        url, request.form, request.headers.get("X-Twilio-Signature", "")
+    )
+
+
 ##########
 
 
@@ -0,0 +1,43 @@
+#!/bin/python3
+
+"""
+Shared fixtures - throwaway copies of jm.db built from schema.sql
+"""
+
+import os
+import pytest
+from utils.connection import close_connections, connect
+from utils.migrations import migrate
+
+SCHEMA = os.path.join(os.path.dirname(os.path.dirname(__file__)), "schema.sql")
+
+
+##########
+
+
+@pytest.fixture
+def baseline(tmp_path):
+    """
+    Path to a version-0 database, built from schema.sql
+    """
+
+    path = str(tmp_path / "jm.db")
+
+    with connect(path) as connection:
+        with open(SCHEMA) as script:
+            connection.executescript(script.read())
+
+    yield path
+
+    close_connections(path)
+
+
+@pytest.fixture
+def database(baseline):
+    """
+    Path to a database migrated to the latest version
+    """
+
+    migrate(connect(baseline))
+
+    return baseline
@@ -0,0 +1,57 @@
+#!/bin/python3
+
+"""
+Regression tests for contact_events - the migrations that move the sent
+markers out of the wide intro_text..pay3 columns and then drop them
+"""
+
+from utils.connection import connect
+from utils.migrations import MARKER_COLUMNS, migrate
+
+
+##########
+
+
+def test_migration_moves_markers_to_contact_events(baseline):
+    rows = [
+        ("Sam Doe", "MISSING", "10/02/2026", "", ""),
+        ("Ian Ferguson", "6502235997", "10/01/2026", "10/01/2026", ""),
+        # A duplicate's markers survive the merge
+        ("Ian Ferguson", "6502235997", "10/01/2026", "", "10/03/2026"),
+    ]
+
+    with connect(baseline) as connection:
+        connection.executemany(
+            """
+            INSERT INTO participants
+            (name, phone_number, date_of_study, intro_text, rem1)
+            VALUES (?,?,?,?,?);
+            """,
+            rows,
+        )
+
+    connection = connect(baseline)
+    migrate(connection)
+
+    events = connection.execute(
+        "SELECT participant_id, slot, sent_at FROM contact_events ORDER BY slot"
+    ).fetchall()
+
+    assert events == [(2, "intro_text", "2026-10-01"), (2, "rem1", "2026-10-03")]
+
+    # The marker columns are gone, and the merged-away id 3 isn't handed out again
+    columns = [row[1] for row in connection.execute("PRAGMA table_info(participants)")]
+    assert not set(columns) & set(MARKER_COLUMNS)
+
+    with connection:
+        connection.execute(
+            """
+            INSERT INTO participants (name, phone_number, date_of_study)
+            VALUES ('Al Bee', '+16502235999', '10/03/2026');
+            """
+        )
+
+    assert connection.execute("SELECT MAX(id) FROM participants").fetchone() == (4,)
+
+    # Upgrading again is a no-op
+    assert migrate(connection) == []
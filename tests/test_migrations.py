@@ -0,0 +1,49 @@
+#!/bin/python3
+
+"""
+Regression tests for the versioned migrations - several processes upgrading
+the same jm.db at once
+"""
+
+import threading
+from time import sleep
+from utils import migrations
+from utils.connection import open_connection
+
+
+##########
+
+
+def test_concurrent_migrations_apply_each_version_once(baseline, monkeypatch):
+    # Slow enough that every worker has started before the first one commits,
+    # and fails if it runs twice
+    steps = [lambda cursor: sleep(0.2), "CREATE TABLE raced (id INTEGER);"]
+    monkeypatch.setattr(migrations, "MIGRATIONS", [(1, "Slow migration", steps)])
+
+    workers = 4
+    barrier = threading.Barrier(workers)
+    applied, errors = [], []
+
+    def upgrade():
+        connection = open_connection(baseline)
+
+        try:
+            barrier.wait()
+            applied.extend(migrations.migrate(connection))
+
+        except Exception as e:
+            errors.append(e)
+
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=upgrade) for _ in range(workers)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert applied == [(1, "Slow migration")]
@@ -0,0 +1,72 @@
+#!/bin/python3
+
+"""
+Regression tests for E.164 phone normalization - the scalar and vectorized
+normalizers, and the migration that merges one person entered in several
+formats
+"""
+
+import pandas as pd
+from utils.connection import connect
+from utils.migrations import migrate
+from utils.phone import phone_key, phone_keys, to_e164, to_e164_series
+
+
+##########
+
+
+def test_phone_normalizers_agree():
+    numbers = [
+        "650-223-5997",
+        "(650) 223 5997",
+        "+1 650 223 5997",
+        "16502235997",
+        6502235997.0,
+        "6502235997.0",
+        "+44 20 7946 0958",
+        "050-223-5997",
+        "12345",
+        "MISSING",
+        None,
+        float("nan"),
+    ]
+
+    scalar = [to_e164(number) for number in numbers]
+    vectorized = list(to_e164_series(pd.Series(numbers, dtype=object)))
+
+    assert vectorized == scalar
+    assert scalar[:6] == ["+16502235997"] * 6
+    assert scalar[6] == "+442079460958"
+    assert scalar[7:] == [None] * 5
+
+    assert list(phone_keys(pd.Series(numbers, dtype=object))) == [
+        phone_key(number) for number in numbers
+    ]
+
+
+def test_migration_merges_number_formats(baseline):
+    rows = [
+        ("Ian Ferguson", "6502235997", "10/01/2026", "False"),
+        ("Ian Ferguson", "(650) 223-5997", "10/01/2026", "1"),
+        ("Sam Doe", "MISSING", "10/02/2026", "False"),
+    ]
+
+    with connect(baseline) as connection:
+        connection.executemany(
+            """
+            INSERT INTO participants (name, phone_number, date_of_study, ignore)
+            VALUES (?,?,?,?);
+            """,
+            rows,
+        )
+
+    migrate(connect(baseline))
+
+    participants = connect(baseline).execute(
+        "SELECT id, name, phone_number, phone_key, ignore FROM participants ORDER BY id"
+    ).fetchall()
+
+    assert participants == [
+        (1, "Ian Ferguson", "+16502235997", 16502235997, "1"),
+        (3, "Sam Doe", "MISSING", None, "False"),
+    ]
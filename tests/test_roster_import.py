@@ -0,0 +1,92 @@
+#!/bin/python3
+
+"""
+Regression tests for idempotent roster imports - the migration that merges
+participants listed more than once, and re-uploading a roster
+"""
+
+from utils.connection import connect
+from utils.db import ParseSubjects
+from utils.migrations import migrate
+from utils.schedule import DEFAULT_COHORT
+
+
+##########
+
+
+def test_migration_merges_duplicate_participants(baseline):
+    rows = [
+        ("Ian Ferguson", "6502235997", "10/01/2026", "False"),
+        ("Ian Ferguson", "6502235997", "10/01/2026", "1"),
+        ("Ian Ferguson", "6502235997", "10/01/2026", "False"),
+        ("Sam Doe", "MISSING", "10/02/2026", "False"),
+    ]
+
+    with connect(baseline) as connection:
+        connection.executemany(
+            """
+            INSERT INTO participants (name, phone_number, date_of_study, ignore)
+            VALUES (?,?,?,?);
+            """,
+            rows,
+        )
+
+    migrate(connect(baseline))
+
+    participants = connect(baseline).execute(
+        "SELECT id, name, ignore FROM participants ORDER BY id"
+    ).fetchall()
+
+    # The oldest row survives, and any ignore flag sticks
+    assert participants == [(1, "Ian Ferguson", "1"), (4, "Sam Doe", "False")]
+
+
+def test_reimport_without_cohort_keeps_stored_cohort(database, tmp_path):
+    roster = tmp_path / "roster.csv"
+    roster.write_text(
+        "subject_name,phone_number,date_of_study\n"
+        "ian ferguson,650-223-5997,10/01/2026\n"
+        "sam doe,650-223-5998,10/02/2026\n"
+    )
+
+    importer = ParseSubjects(app_path=str(tmp_path), file=str(roster))
+    first = importer.run()
+    assert first == {"inserted": 2, "updated": 0, "unchanged": 0, "duplicates": 0}
+
+    with connect(database) as connection:
+        connection.execute("UPDATE participants SET cohort = 'pilot' WHERE id = 1;")
+
+    # The same roster again, which has no cohort column
+    again = importer.run()
+    assert again == {"inserted": 0, "updated": 0, "unchanged": 2, "duplicates": 0}
+
+    cohorts = connect(database).execute(
+        "SELECT name, cohort FROM participants ORDER BY id"
+    ).fetchall()
+
+    assert cohorts == [("Ian Ferguson", "pilot"), ("Sam Doe", DEFAULT_COHORT)]
+
+
+def test_import_counts_repeated_rows_separately(database, tmp_path):
+    roster = tmp_path / "roster.csv"
+    roster.write_text(
+        "subject_name,phone_number,date_of_study\n"
+        "ian ferguson,650-223-5997,10/01/2026\n"
+        "sam doe,650-223-5998,10/02/2026\n"
+        "Ian Ferguson,(650) 223-5997,10/05/2026\n"
+    )
+
+    importer = ParseSubjects(app_path=str(tmp_path), file=str(roster))
+
+    # The last listing of a person wins, and the earlier one isn't "unchanged"
+    first = importer.run()
+    assert first == {"inserted": 2, "updated": 0, "unchanged": 0, "duplicates": 1}
+
+    again = importer.run()
+    assert again == {"inserted": 0, "updated": 0, "unchanged": 2, "duplicates": 1}
+
+    dates = connect(database).execute(
+        "SELECT name, date_of_study FROM participants ORDER BY name"
+    ).fetchall()
+
+    assert dates == [("Ian Ferguson", "10/05/2026"), ("Sam Doe", "10/02/2026")]
@@ -0,0 +1,74 @@
+#!/bin/python3
+
+"""
+Regression tests for the cohort schedule registry - participants whose
+cohort has no schedule are rejected on import and flagged in the plan
+"""
+
+import os
+import pandas as pd
+import pytest
+from datetime import date
+from utils import helper
+from utils.connection import connect
+from utils.db import ParseSubjects
+from utils.schedule import load_schedules
+
+SCHEDULES = os.path.join(os.path.dirname(os.path.dirname(__file__)), "schedules")
+
+
+##########
+
+
+@pytest.fixture
+def schedules(monkeypatch):
+    """
+    The repo's schedules, in place of the deployed folder
+    """
+
+    registry = load_schedules(SCHEDULES)
+    monkeypatch.setattr(helper, "SCHEDULES", registry)
+
+    return registry
+
+
+def test_plan_flags_unknown_cohorts(schedules):
+    frame = pd.DataFrame(
+        {
+            "id": [1, 2, 3],
+            "name": ["Ian Ferguson", "Sam Doe", "Al Bee"],
+            "phone_number": ["+16502235997", "+16502235998", "+16502235999"],
+            "study_day": ["2026-10-18"] * 3,
+            "cohort": ["narratives", "pilot", "pilot"],
+            "ignore": ["False", "False", "1"],
+            "sent_slots": [None] * 3,
+        }
+    )
+
+    items = helper.plan_to_items(helper.plan_texts(frame, today=date(2026, 10, 18)))
+
+    assert [(item["name"], item["skip_reason"]) for item in items] == [
+        ("Ian Ferguson", None),
+        ("Sam Doe", "unknown cohort"),
+    ]
+
+
+def test_import_rejects_unknown_cohorts(schedules, database, tmp_path):
+    roster = tmp_path / "roster.csv"
+    roster.write_text(
+        "subject_name,phone_number,date_of_study,cohort\n"
+        "ian ferguson,650-223-5997,10/01/2026,narratives\n"
+        "sam doe,650-223-5998,10/02/2026,pilot\n"
+    )
+
+    # One row per chunk, so the first is upserted before the second fails
+    importer = ParseSubjects(
+        str(tmp_path), str(roster), chunksize=1, cohorts=schedules
+    )
+
+    with pytest.raises(ValueError, match="pilot"):
+        importer.run()
+
+    count = connect(database).execute("SELECT COUNT(*) FROM participants")
+
+    assert count.fetchone() == (0,)
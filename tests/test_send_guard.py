@@ -0,0 +1,56 @@
+#!/bin/python3
+
+"""
+Regression tests for the double-send guard - the write-ahead outbox that
+claims each (participant, slot, day) before a text goes out
+"""
+
+import pytest
+from utils.connection import connect
+from utils.outbox import AlreadySent, claim, complete, fail
+
+
+##########
+
+
+def outbox_row(path):
+    return connect(path).execute("SELECT status, attempts, sid FROM outbox").fetchone()
+
+
+#####
+
+
+def test_claim_fail_reclaim(database):
+    claim(database, 1, "rem1", "2026-10-18")
+    fail(database, 1, "rem1", "2026-10-18", error="timeout")
+
+    assert outbox_row(database) == ("failed", 1, None)
+
+    # A failed attempt may be tried again
+    claim(database, 1, "rem1", "2026-10-18")
+    complete(database, 1, "rem1", "2026-10-18", sid="SM1")
+
+    assert outbox_row(database) == ("sent", 2, "SM1")
+
+
+@pytest.mark.parametrize("settled", ["pending", "sent"])
+def test_claim_refuses_pending_and_sent(database, settled):
+    claim(database, 1, "rem1", "2026-10-18")
+
+    if settled == "sent":
+        complete(database, 1, "rem1", "2026-10-18", sid="SM1")
+
+    with pytest.raises(AlreadySent) as raised:
+        claim(database, 1, "rem1", "2026-10-18")
+
+    assert raised.value.status == settled
+    assert outbox_row(database)[1] == 1
+
+
+def test_claim_is_per_slot_and_day(database):
+    claim(database, 1, "rem1", "2026-10-18")
+    claim(database, 1, "rem2", "2026-10-18")
+    claim(database, 1, "rem1", "2026-10-19")
+    claim(database, 2, "rem1", "2026-10-18")
+
+    assert connect(database).execute("SELECT COUNT(*) FROM outbox").fetchone() == (4,)
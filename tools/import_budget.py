@@ -0,0 +1,77 @@
+#!/bin/python3
+
+"""
+IMPORT BUDGET CHECK
+
+Imports the app in a fresh interpreter with `python -X importtime`,
+reports the modules that cost the most at startup, and fails if the
+total exceeds the budget
+
+Usage
+    python tools/import_budget.py --budget 800 --top 15 --module main
+"""
+
+import argparse, os, subprocess, sys
+
+
+##########
+
+
+def measure(module: str):
+    """
+    Returns [(cumulative_us, self_us, module_name)] for every module imported
+    while importing module, plus the total import time in microseconds
+    """
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=root,
+        capture_output=True,
+        text=True,
+    )
+
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    rows = []
+
+    for line in result.stderr.splitlines():
+
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        rows.append((int(cumulative_us), int(self_us), name.rstrip()))
+
+    # Top-level imports are the ones with no indentation in the tree
+    total = sum(cumulative for cumulative, _, name in rows if not name.startswith("  "))
+
+    return rows, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report startup cost per module")
+    parser.add_argument("--module", default="main", help="Module to import")
+    parser.add_argument("--budget", type=float, default=800, help="Budget in ms")
+    parser.add_argument("--top", type=int, default=15, help="Modules to list")
+    args = parser.parse_args()
+
+    rows, total = measure(args.module)
+
+    print(f"\n== Import cost for {args.module}: {total / 1000:.1f} ms ==\n")
+    print(f"{'cumulative ms':>14} {'self ms':>9}  module")
+
+    for cumulative, self_us, name in sorted(rows, reverse=True)[: args.top]:
+        print(f"{cumulative / 1000:>14.1f} {self_us / 1000:>9.1f}  {name.strip()}")
+
+    if total / 1000 > args.budget:
+        print(f"\n** Over budget: {total / 1000:.1f} ms > {args.budget:.0f} ms **\n")
+        sys.exit(1)
+
+    print(f"\n** Within budget ({args.budget:.0f} ms) **\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#!/bin/python3
+import threading
+from time import monotonic
+
+
+##########
+
+
+class TTLCache:
+    def __init__(self):
+        """
+        Small in-process cache whose entries expire after a per-call TTL
+
+        Values are computed at most once per key at a time; concurrent callers
+        wait for the first one to finish instead of repeating the work
+        """
+
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.key_locks = {}
+
+    def get(self, key, ttl, compute):
+        """
+        Returns the cached value for key, calling compute() if it's missing
+        or older than ttl seconds
+
+        Parameters
+            key: str | Cache key
+            ttl: float | Maximum age in seconds (0 always recomputes)
+            compute: callable | Builds the value on a miss
+        """
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and monotonic() - entry[0] < ttl:
+                return entry[1]
+
+            value = compute()
+            self.entries[key] = (monotonic(), value)
+
+            return value
+
+    def invalidate(self, key=None):
+        """
+        Drops one cached key, or every key when none is given
+        """
+
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
@@ -0,0 +1,122 @@
+#!/bin/python3
+
+"""
+Shared SQLite connections for jm.db
+
+Every thread gets one long-lived, tuned connection per database file instead
+of opening a fresh one per call. The database runs in WAL mode, so readers
+(log pages, lookups) never block the writer during a distribution run, and
+a busy timeout makes writers wait for each other instead of failing
+"""
+
+import sqlite3, threading
+
+
+##########
+
+
+# Applied to every connection we open
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA cache_size = -16000;",
+    "PRAGMA busy_timeout = 5000;",
+    "PRAGMA temp_store = MEMORY;",
+]
+
+# Prepared statements kept per connection
+CACHED_STATEMENTS = 256
+
+local = threading.local()
+registry_lock = threading.Lock()
+registry = []
+
+
+def open_connection(database_path: str):
+    """
+    Opens a new, tuned connection that the caller owns and must close
+    """
+
+    connection = sqlite3.connect(
+        database_path,
+        timeout=5.0,
+        cached_statements=CACHED_STATEMENTS,
+        check_same_thread=False,
+    )
+
+    for pragma in PRAGMAS:
+        connection.execute(pragma)
+
+    return connection
+
+
+def connect(database_path: str):
+    """
+    This function returns this thread's pooled connection to database_path,
+    opening it on first use
+
+    Use it as `with connect(path) as connection:` - the block commits or rolls
+    back like sqlite3.connect, but the connection stays open for reuse
+
+    Parameters
+        database_path: str | Path to jm.db
+    """
+
+    connections = getattr(local, "connections", None)
+
+    if connections is None:
+        connections = local.connections = {}
+
+    connection = connections.get(database_path)
+
+    if connection is None:
+        connection = open_connection(database_path)
+        connections[database_path] = connection
+
+        with registry_lock:
+            prune()
+            registry.append(
+                (database_path, connection, connections, threading.current_thread())
+            )
+
+    return connection
+
+
+def prune():
+    """
+    Closes connections left behind by threads that have exited
+    (callers hold registry_lock)
+    """
+
+    alive = []
+
+    for entry in registry:
+
+        if entry[3].is_alive():
+            alive.append(entry)
+        else:
+            entry[1].close()
+
+    registry[:] = alive
+
+
+def close_connections(database_path: str = None):
+    """
+    Closes every pooled connection (or only those to database_path), e.g.,
+    before the database file is deleted and recreated
+    """
+
+    with registry_lock:
+        keep = []
+
+        for entry in registry:
+            path, connection, owner = entry[:3]
+
+            if database_path is not None and path != database_path:
+                keep.append(entry)
+                continue
+
+            owner.pop(path, None)
+            connection.close()
+
+        registry[:] = keep
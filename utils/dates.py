@@ -0,0 +1,38 @@
+#!/bin/python3
+from datetime import date, datetime
+
+
+##########
+
+
+# Formats we've seen in date_of_study, most common first
+STUDY_DATE_FORMATS = ["%m/%d/%Y", "%Y-%m-%d", "%Y-%m-%d %H:%M:%S", "%m/%d/%y"]
+
+
+def to_study_day(study_date):
+    """
+    Converts a participant's date_of_study into a sortable ISO date string
+    (e.g., 5/26/2022 => 2022-05-26) so it can be indexed and compared in SQL
+
+    Parameters
+        study_date: str or datetime | Date that subject will engage with our research
+
+    Returns
+        ISO date string, or None if the value can't be parsed
+    """
+
+    if isinstance(study_date, datetime):
+        return study_date.date().isoformat()
+
+    if isinstance(study_date, date):
+        return study_date.isoformat()
+
+    value = str(study_date).strip()
+
+    for fmt in STUDY_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date().isoformat()
+        except ValueError:
+            continue
+
+    return None
@@ -1,49 +1,209 @@
 #!/bin/python3
-import pandas as pd
-import os, sqlite3
+import os
+from utils.connection import connect
+from utils.lazy import LazyModule
+from utils.dates import to_study_day
+from utils.phone import clean_number, clean_numbers, phone_key, phone_keys
+from utils.schedule import DEFAULT_COHORT
+
+# Imported on first upload rather than at app start
+pd = LazyModule("pandas")
 
 
 ##########
 
 
 class ParseSubjects:
-    def __init__(self, app_path: os.path, file: str):
+    def __init__(
+        self, app_path: os.path, file: str, chunksize: int = 10000, cohorts=None
+    ):
+        """
+        Parameters
+            app_path: os.path | Folder holding jm.db
+            file: str | Path to the uploaded .csv or .xlsx roster
+            chunksize: int | CSV rows read and upserted at a time
+            cohorts: iterable | Cohorts with a schedule - uploads naming any
+                     other cohort are rejected (None skips the check)
+        """
 
         self.file = file
         self.database_path = os.path.join(app_path, "jm.db")
+        self.chunksize = chunksize
+        self.cohorts = set(cohorts) if cohorts is not None else None
 
     def load_file(self):
         """
-        Read user-supplied file as Pandas DataFrame
+        Read user-supplied file as an iterator of Pandas DataFrames
+
+        CSVs are read chunksize rows at a time, so only one chunk is held in
+        memory; Excel workbooks can't be streamed and arrive as a single chunk
         """
 
         if ".csv" in self.file:
-            return pd.read_csv(self.file)
+            return pd.read_csv(self.file, chunksize=self.chunksize)
 
         elif ".xlsx" in self.file:
-            return pd.read_excel(self.file, engine="openpyxl")
+            return iter([pd.read_excel(self.file, engine="openpyxl")])
 
-    def push_to_database(self, cursor, name, number, date):
+        raise ValueError(f"Unsupported file type: {self.file}")
+
+    def push_to_database(self, cursor, name, number, date, cohort=None):
         """
         Add observations to DB as a single-row
+
+        Without a cohort, an existing participant keeps theirs and a new one
+        follows the default schedule
         """
 
         query = """
-            INSERT INTO participants (name,phone_number,date_of_study)
-            VALUES (?,?,?);
+            INSERT INTO participants
+             (name,phone_number,phone_key,date_of_study,study_day,cohort)
+            VALUES (?,?,?,?,?,COALESCE(?,
+             (SELECT cohort FROM participants WHERE name = ? AND phone_number = ?),
+             ?))
+            ON CONFLICT (name, phone_number) DO UPDATE SET
+             phone_key = excluded.phone_key,
+             date_of_study = excluded.date_of_study,
+             study_day = excluded.study_day,
+             cohort = excluded.cohort;
             """
 
-        cursor.execute(query, (name, number, date))
+        number = clean_number(number)
+
+        cursor.execute(
+            query,
+            (
+                name,
+                number,
+                phone_key(number),
+                date,
+                to_study_day(date),
+                cohort,
+                name,
+                number,
+                DEFAULT_COHORT,
+            ),
+        )
 
-    def clean_file(self):
+    def push_chunk(self, cursor, file):
         """
-        Confirms that user has supplied an adequate file to parse
+        Upserts a cleaned chunk of observations keyed on (name, phone_number)
+
+        The chunk is staged in a temp table first so we can report how many
+        rows are new, how many change an existing participant's study date
+        or cohort, how many are already in the database as-is, and how many
+        repeat a person listed again later in the chunk
+
+        Returns
+            Dictionary of inserted, updated, unchanged and duplicates counts
         """
 
-        file = self.load_file()
+        columns = ["subject_name", "phone_number", "phone_key", "date_of_study"]
+        columns += ["study_day", "cohort"]
+
+        cursor.execute("DELETE FROM staging;")
+        cursor.executemany(
+            """
+            INSERT INTO staging
+             (name,phone_number,phone_key,date_of_study,study_day,cohort)
+            VALUES (?,?,?,?,?,?);
+            """,
+            file.loc[:, columns].itertuples(index=False, name=None),
+        )
+
+        # The same person listed twice in one upload => last row wins
+        cursor.execute(
+            """
+            DELETE FROM staging WHERE rowid NOT IN (
+             SELECT MAX(rowid) FROM staging GROUP BY name, phone_number
+            );
+            """
+        )
+
+        staged = cursor.execute("SELECT COUNT(*) FROM staging;").fetchone()[0]
+
+        # Rows without a cohort keep the stored one (new participants get the
+        # default), so re-uploading an older roster doesn't reset schedules
+        cursor.execute(
+            """
+            UPDATE staging SET cohort = COALESCE(
+             (SELECT p.cohort FROM participants p
+              WHERE p.name = staging.name AND p.phone_number = staging.phone_number),
+             ?
+            ) WHERE cohort IS NULL;
+            """,
+            (DEFAULT_COHORT,),
+        )
+
+        inserted, updated = cursor.execute(
+            """
+            SELECT
+             COALESCE(SUM(p.id IS NULL), 0),
+             COALESCE(SUM(p.id IS NOT NULL AND (p.date_of_study IS NOT s.date_of_study
+                 OR p.cohort IS NOT s.cohort OR p.phone_key IS NOT s.phone_key)), 0)
+            FROM staging s
+            LEFT JOIN participants p
+             ON p.name = s.name AND p.phone_number = s.phone_number;
+            """
+        ).fetchone()
+
+        cursor.execute(
+            """
+            INSERT INTO participants
+             (name,phone_number,phone_key,date_of_study,study_day,cohort)
+            SELECT name, phone_number, phone_key, date_of_study, study_day, cohort
+            FROM staging WHERE true
+            ON CONFLICT (name, phone_number) DO UPDATE SET
+             phone_key = excluded.phone_key,
+             date_of_study = excluded.date_of_study,
+             study_day = excluded.study_day,
+             cohort = excluded.cohort
+            WHERE participants.date_of_study IS NOT excluded.date_of_study
+             OR participants.cohort IS NOT excluded.cohort
+             OR participants.phone_key IS NOT excluded.phone_key;
+            """
+        )
+
+        return {
+            "inserted": inserted,
+            "updated": updated,
+            "unchanged": staged - inserted - updated,
+            "duplicates": len(file) - staged,
+        }
+
+    def clean_file(self, file=None):
+        """
+        Confirms that user has supplied an adequate file to parse, and cleans
+        names, phone numbers and dates with vectorized string operations
+
+        Parameters
+            file: Pandas DataFrame | Chunk to clean (defaults to the whole file)
+        """
+
+        if file is None:
+            file = pd.concat(self.load_file(), ignore_index=True)
 
         column_targets = ["subject_name", "phone_number", "date_of_study"]
 
+        # Optional column - blank or missing cohorts are resolved in push_chunk
+        if "cohort" in file.columns:
+            cohorts = file["cohort"].astype(object)
+            blank = cohorts.isna()
+            cohorts = cohorts.astype(str).str.strip().astype(object)
+            cohorts[blank] = None
+
+            # A cohort without a schedule would never be texted
+            if self.cohorts is not None:
+                unknown = sorted(set(cohorts[~blank]) - self.cohorts)
+
+                if unknown:
+                    raise ValueError(
+                        f"Unknown cohort(s) {', '.join(unknown)} - schedules exist "
+                        f"for {', '.join(sorted(self.cohorts))}"
+                    )
+        else:
+            cohorts = None
+
         try:
             file = file.loc[:, column_targets]
         except:
@@ -51,56 +211,67 @@ class ParseSubjects:
                 f"Check column names - we need the following: {column_targets}"
             )
 
-        file.fillna("MISSING", inplace=True)
-
-        ###
-
-        def clean_phone_number(x):
-            """
-            Remove all extraneous characters from phone number
-            """
-
-            try:
-                x = str(int(x))
-            except:
-                x = str(x)
+        # Excel hands us real dates - store them in the same format as CSV uploads
+        dates = file["date_of_study"]
+        is_date = dates.map(lambda x: hasattr(x, "strftime"))
+        dates = dates.astype(object)
+        dates[is_date] = pd.to_datetime(dates[is_date]).dt.strftime("%m/%d/%Y")
 
-            ###
+        file = file.assign(date_of_study=dates).fillna("MISSING")
+        file["cohort"] = cohorts
 
-            for char in ["-", "+1", "(", ")"]:
-                x = x.replace(char, "")
+        ###
 
-            return x.strip()
+        # Remove whitespace from name strings and standardize casing
+        file["subject_name"] = file["subject_name"].astype(str).str.title().str.strip()
 
-        def clean_name(x):
-            """
-            Remove any whitespace from name string and standardize casing
-            """
+        # E.164 phone numbers, so one person in several formats is one participant
+        # (MISSING and other undiallable numbers are kept as entered, without a key)
+        file["phone_number"] = clean_numbers(file["phone_number"])
+        file["phone_key"] = phone_keys(file["phone_number"])
 
-            return x.title().strip()
+        # Sortable ISO date for SQL-side scheduling
+        study_day = pd.to_datetime(
+            file["date_of_study"], format="%m/%d/%Y", errors="coerce"
+        ).dt.strftime("%Y-%m-%d")
 
-        ###
+        unparsed = study_day.isna()
+        study_day[unparsed] = file["date_of_study"][unparsed].map(to_study_day)
 
-        file["subject_name"] = file["subject_name"].apply(lambda x: clean_name(x))
-        file["phone_number"] = file["phone_number"].apply(
-            lambda x: clean_phone_number(x)
-        )
+        file["study_day"] = study_day.astype(object).where(study_day.notna(), None)
 
         return file
 
     def run(self):
         """
         Wraps all intake and cleaning functions
+
+        Each chunk is cleaned and upserted with executemany, and the whole
+        upload is committed as one transaction, so importing the same roster
+        twice never duplicates participants
+
+        Returns
+            Dictionary of inserted, updated, unchanged and duplicates counts
         """
 
-        file = self.clean_file()
+        counts = {"inserted": 0, "updated": 0, "unchanged": 0, "duplicates": 0}
 
-        with sqlite3.connect(self.database_path) as connection:
+        with connect(self.database_path) as connection:
             cursor = connection.cursor()
 
-            for ix, name in enumerate(file["subject_name"]):
+            cursor.execute(
+                """
+                CREATE TEMP TABLE IF NOT EXISTS staging (
+                 name TEXT, phone_number TEXT, phone_key INTEGER,
+                 date_of_study TEXT, study_day TEXT, cohort TEXT
+                );
+                """
+            )
+
+            for chunk in self.load_file():
+                file = self.clean_file(chunk)
 
-                phone = file["phone_number"][ix]
-                date = file["date_of_study"][ix]
+                for key, value in self.push_chunk(cursor=cursor, file=file).items():
+                    counts[key] += value
 
-                self.push_to_database(cursor=cursor, name=name, number=phone, date=date)
+        return counts
@@ -0,0 +1,101 @@
+#!/bin/python3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import monotonic, sleep
+
+
+##########
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Thread-safe token bucket used to keep outgoing API calls under
+        our account's messages-per-second cap
+
+        Parameters
+            rate: float | Tokens added per second (e.g., 1.0 for a long code)
+            capacity: float | Largest burst allowed, defaults to one second of tokens
+        """
+
+        if rate <= 0:
+            raise ValueError(f"Token bucket rate must be positive, got {rate}")
+
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Blocks until a single token is available and consumes it
+        """
+
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            sleep(wait)
+
+
+def dispatch(jobs, send, max_workers: int = 8, per_second: float = None):
+    """
+    This function runs send(job) for every job with a bounded number of
+    calls in flight, and yields each job with the exception it raised (or None)
+    as soon as it finishes
+
+    Results are yielded in the calling thread, so callers can safely flash
+    messages or write to the database while the pool keeps sending. If the
+    caller stops early (closes the generator, or it is garbage collected),
+    queued jobs are cancelled and only the sends already in flight finish
+
+    Parameters
+        jobs: iterable | Units of work handed to send
+        send: callable | Function that performs a single send
+        max_workers: int | Upper bound on concurrent sends
+        per_second: float | Messages-per-second cap (None disables rate limiting)
+    """
+
+    bucket = TokenBucket(per_second) if per_second else None
+    stopped = threading.Event()
+
+    def attempt(job):
+        if bucket is not None:
+            bucket.acquire()
+
+        # Nobody is collecting results any more => don't start another send
+        if stopped.is_set():
+            return None
+
+        try:
+            send(job)
+            return None
+
+        except Exception as e:
+            return e
+
+    pool = ThreadPoolExecutor(max_workers=max(1, int(max_workers)))
+    futures = {pool.submit(attempt, job): job for job in jobs}
+
+    try:
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    finally:
+        stopped.set()
+
+        for future in futures:
+            future.cancel()
+
+        pool.shutdown(wait=True)
@@ -1,10 +1,42 @@
 #!/bin/python3
-import sqlite3, json, os, pytz
-from datetime import datetime
-import pandas as pd
-from twilio.rest import Client
-from time import sleep
+import json, os, pytz, threading
+from contextlib import closing
+from datetime import datetime, timedelta
+from time import perf_counter, sleep
 from flask import flash
+from utils.dispatch import dispatch
+from utils.migrations import migrate
+from utils.dates import to_study_day
+from utils.schedule import DEFAULT_COHORT, load_schedules
+from utils.history import (
+    INBOUND_SQL,
+    STATUS_CALLBACK_SQL,
+    sync_messages,
+    to_utc_string,
+)
+from utils.cache import TTLCache
+from utils.writer import BackgroundWriter
+from utils.connection import close_connections, connect
+from utils.lazy import LazyModule
+from utils.transport import make_transport
+from utils.metrics import DB_SECONDS, MESSAGES, TWILIO_SECONDS, timed
+from utils.outbox import AlreadySent, claim, complete, fail
+from utils.jobs import JobAlreadyRunning, active_job, job_status, run_job
+from utils.plans import (
+    ITEM_COLUMNS,
+    PlanUnavailable,
+    check_plan,
+    claim_plan,
+    finish_plan,
+    load_plan,
+    save_plan,
+)
+from utils.paging import decode_cursor, fetch_page, iter_rows, keyset_query
+from utils.phone import clean_number, number_match, phone_key, to_e164
+
+# Heavy imports are deferred until a function actually needs them
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
 
 
 ##########
@@ -25,202 +57,654 @@ def twilio_init():
     with open(os.path.join(here, "packets/twilio.json")) as incoming:
         creds = json.load(incoming)
 
-    return creds["sid"], creds["auth"], creds["my_number"]
+    # status_callback is optional - the public URL of our /sms/status route
+    return (
+        creds["sid"],
+        creds["auth"],
+        creds["my_number"],
+        creds.get("status_callback"),
+    )
+
+
+# All data access goes through utils.connection's pooled connections
+DATABASE = os.path.join(here, "jm.db")
 
 
 #####
 
 
-TWIL_account, TWIL_auth, TWIL_number = twilio_init()
-API = Client(TWIL_account, TWIL_auth)
+# Twilio credentials and the text transport are built on first use, not at import
+TWILIO = None
+TWILIO_LOCK = threading.Lock()
+
+# "twilio", or "simulated" / "recording" to run without touching the network
+TRANSPORT = None
+TRANSPORT_KIND = "twilio"
+TRANSPORT_OPTIONS = {}
+
+
+def twilio_creds():
+    """
+    Returns (account, auth, number, status_callback), reading
+    packets/twilio.json the first time it's needed
+    """
+
+    global TWILIO
+
+    with TWILIO_LOCK:
+        if TWILIO is None:
+            TWILIO = twilio_init()
+
+    return TWILIO
+
+
+def twilio_number():
+    """
+    Our Twilio phone number
+    """
+
+    return twilio_creds()[2]
+
+
+def use_transport(kind, **options):
+    """
+    This function chooses where texts are sent and read from
+
+    Parameters
+        kind: str or transport | "twilio", "simulated" or "recording" (built
+              on first use), or a ready-made transport object
+        options: Keyword arguments for utils.transport.make_transport
+    """
+
+    global TRANSPORT, TRANSPORT_KIND, TRANSPORT_OPTIONS
+
+    with TWILIO_LOCK:
+        if isinstance(kind, str):
+            TRANSPORT, TRANSPORT_KIND, TRANSPORT_OPTIONS = None, kind, options
+        else:
+            TRANSPORT = kind
+
+
+def text_transport():
+    """
+    Returns the shared transport (see utils/transport.py), creating it on
+    first use; every send and message read goes through it
+    """
+
+    global TRANSPORT
+
+    if TRANSPORT is None:
+        account, auth = (None, None)
+
+        if TRANSPORT_KIND == "twilio":
+            account, auth = twilio_creds()[:2]
+
+        with TWILIO_LOCK:
+            if TRANSPORT is None:
+                TRANSPORT = make_transport(
+                    TRANSPORT_KIND, account=account, auth=auth, **TRANSPORT_OPTIONS
+                )
+
+    return TRANSPORT
+
+
+def __getattr__(name):
+    """
+    Keeps the old TWIL_* module attributes importable, resolved lazily
+    """
+
+    names = ["TWIL_account", "TWIL_auth", "TWIL_number", "TWIL_callback"]
+
+    if name in names:
+        return twilio_creds()[names.index(name)]
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Webhook writes are handed to a single background thread
+WRITER = BackgroundWriter(DATABASE)
+
+
+# Seconds a message sync stays fresh before we hit the Twilio API again
+MESSAGE_CACHE_TTL = 60
+MESSAGE_CACHE = TTLCache()
+
+
+# Twilio logs numbers in E.164, so "+1650..." => 1650... is an exact phone_key index hit
+PARTICIPANT_BY_NUMBER = """(SELECT name FROM participants
+          WHERE phone_key = CAST(substr({number}, 2) AS INTEGER)
+          LIMIT 1) AS participant"""
+
+# Texts that never reached the participant (Twilio reports either, by error code)
+UNDELIVERED = "status IN ('undelivered', 'failed')"
+
+# Paginated log views => table, columns, sortable keys and search clause
+LOG_VIEWS = {
+    "participants": {
+        "table": "participants",
+        "select": """id, name, phone_number, date_of_study, cohort, ignore,
+         (SELECT group_concat(slot || ' ' || sent_at, ', ') FROM contact_events
+          WHERE participant_id = participants.id) AS contacted""",
+        "sort": {"id": "id", "name": "name"},
+        "order": "asc",
+        "tiebreak": "id",
+        "search": "name LIKE ? OR phone_number LIKE ?",
+    },
+    "outgoing": {
+        "table": "messages",
+        "select": f"""date_created AS date, to_number AS sent_to, body,
+         {PARTICIPANT_BY_NUMBER.format(number="to_number")}""",
+        "owner": "from_number",
+        "sort": {"date": "date_created"},
+        "order": "desc",
+        "tiebreak": "sid",
+        "search": "to_number LIKE ? OR body LIKE ?",
+    },
+    "incoming": {
+        "table": "messages",
+        "select": f"""date_created AS date, from_number AS sent_from, body,
+         {PARTICIPANT_BY_NUMBER.format(number="from_number")}""",
+        "owner": "to_number",
+        "sort": {"date": "date_created"},
+        "order": "desc",
+        "tiebreak": "sid",
+        "search": "from_number LIKE ? OR body LIKE ?",
+    },
+    "errors": {
+        "table": "messages",
+        "select": f"""COALESCE(date_sent, status_updated) AS date, to_number AS "to",
+         body, {PARTICIPANT_BY_NUMBER.format(number="to_number")}""",
+        "where": [UNDELIVERED],
+        "sort": {"date": "date_created"},
+        "order": "desc",
+        "tiebreak": "sid",
+        "search": "to_number LIKE ? OR body LIKE ?",
+    },
+}
+
+
+# Texting schedules for every cohort, compiled once (on first use) into offset lookups
+SCHEDULES = None
+
+
+def get_schedules():
+    """
+    Returns the compiled cohort => Schedule registry, loading schedules/*.json
+    the first time it's needed
+    """
+
+    global SCHEDULES
+
+    if SCHEDULES is None:
+        SCHEDULES = load_schedules(os.path.join(here, "schedules"))
+
+    return SCHEDULES
 
 
 #####
 
 
-def send_texts(dataframe):
+class FlashProgress:
+    """
+    Default progress sink for send_texts - reports each participant who
+    wasn't contacted through flash, as the /distribute page always has
+    """
+
+    def start(self, total):
+        pass
+
+    def sent(self):
+        pass
+
+    def skipped(self, message):
+        flash(message)
+
+    def failed(self, message):
+        flash(message)
+
+
+def send_texts(
+    dataframe, concurrent=False, max_workers=8, per_second=1.0, progress=None
+):
     """
     This function loops through subjects in a dataframe and
     contacts them via SMS text unless they are marked "ignore"
 
     Parameters
         dataframe: Pandas DataFrame
+        concurrent: Boolean | if True, sends are spread across a thread pool
+        max_workers: int | Upper bound on sends in flight when concurrent
+        per_second: float | Account messages-per-second cap when concurrent
+        progress: object | Receives start / sent / skipped / failed calls
+                  (defaults to flash messages; a background Job records counts)
     """
 
-    # Current date, e.g., 5/26/2022
-    today = datetime.now(pytz.timezone("US/Pacific")).strftime("%m/%d/%Y")
+    # Texts that need to go out today, evaluated for every row at once
+    send_items(
+        items=plan_to_items(plan_texts(dataframe)),
+        concurrent=concurrent,
+        max_workers=max_workers,
+        per_second=per_second,
+        progress=progress,
+    )
 
-    # Loop through rows in the dataframe
-    for ix, name in enumerate(dataframe["name"]):
 
-        # Skip over subjects marked ignore
-        if dataframe["ignore"][ix] != "False":
-            continue
+def send_items(items, concurrent=False, max_workers=8, per_second=1.0, progress=None):
+    """
+    This function sends a list of planned texts exactly as given - the
+    schedule is not evaluated again
 
-        # Participant contact number and study date
-        contact_number = dataframe["phone_number"][ix]
-        study_date = dataframe["date_of_study"][ix]
+    Parameters
+        items: list | Dictionaries with ITEM_COLUMNS keys (see plan_to_items)
+        concurrent: Boolean | if True, sends are spread across a thread pool
+        max_workers: int | Upper bound on sends in flight when concurrent
+        per_second: float | Account messages-per-second cap when concurrent
+        progress: object | Receives start / sent / skipped / failed calls
+    """
 
-        if contact_number == "MISSING":
-            flash(f"{name} not contacted (missing number)")
-            continue
+    if progress is None:
+        progress = FlashProgress()
 
-        # E.g., Ian Ferguson => Ian
-        first_name = name.split(" ")[0].title()
+    # Study date for the outbox key, and the time recorded against each text
+    now = datetime.now(pytz.timezone("US/Pacific"))
+    study_date = now.date().isoformat()
+    sent_at = now.replace(tzinfo=None).isoformat(timespec="seconds")
 
-        # Text message body derived from helper function
-        variable, message = message_tree(study_date=study_date, first_name=first_name)
+    progress.start(total=len(items))
 
-        # Text needs to go out
-        if message is not None:
+    jobs = []
 
-            # Avoid double-texting
-            if variable != today:
+    for item in items:
 
-                try:
-                    # Send text message
-                    API.messages.create(
-                        to=contact_number, from_=TWIL_number, body=message
-                    )
+        if item["skip_reason"]:
+            progress.skipped(f"{item['name']} not contacted ({item['skip_reason']})")
+            MESSAGES.inc(slot=item["variable"], outcome="skipped")
+            continue
+
+        jobs.append(
+            {
+                "participant_id": item["participant_id"],
+                "study_date": study_date,
+                "variable": item["variable"],
+                "name": item["name"],
+                "first_name": item["first_name"],
+                "contact_number": item["phone_number"],
+                "message": item["message"],
+            }
+        )
 
-                    # Update subject's information on database
-                    update_contact_date(
-                        variable_name=variable,
-                        full_name=name,
-                        contact_number=contact_number,
-                        new_date=today,
+    if concurrent:
+        results = dispatch(
+            jobs, deliver_text, max_workers=max_workers, per_second=per_second
+        )
+    else:
+        results = ((job, attempt_text(job)) for job in jobs)
+
+    # Results come back in this thread, so progress and SQLite stay single-threaded.
+    # If recording fails, closing results cancels the sends still queued
+    with ContactDateWriter(new_date=sent_at) as writer, closing(results):
+        for job, error in results:
+
+            if isinstance(error, AlreadySent):
+                progress.skipped(f"{job['name']} not contacted ({error})")
+                MESSAGES.inc(slot=job["variable"], outcome="skipped")
+
+                # Sent by a run that died before recording it => repair the marker
+                if error.status == "sent":
+                    writer.add(
+                        variable_name=job["variable"],
+                        full_name=job["name"],
+                        contact_number=job["contact_number"],
+                        participant_id=job["participant_id"],
                     )
 
-                except Exception as e:
-                    flash(f"{first_name} was NOT contacted ... {e}")
+                continue
+
+            if error is not None:
+                progress.failed(f"{job['first_name']} was NOT contacted ... {error}")
+                MESSAGES.inc(slot=job["variable"], outcome="failed")
+                continue
+
+            try:
+                # Queue update to subject's information on database
+                writer.add(
+                    variable_name=job["variable"],
+                    full_name=job["name"],
+                    contact_number=job["contact_number"],
+                    participant_id=job["participant_id"],
+                    sid=job.get("sid"),
+                )
+                progress.sent()
+                MESSAGES.inc(slot=job["variable"], outcome="sent")
 
+            except Exception as e:
+                progress.failed(f"{job['first_name']} was NOT contacted ... {e}")
+                MESSAGES.inc(slot=job["variable"], outcome="failed")
 
-def message_tree(study_date, first_name):
+    # New outgoing texts => cached message views are stale
+    if jobs:
+        invalidate_message_cache()
+
+
+def plan_to_items(plan):
+    """
+    Converts the output of plan_texts into plan items, noting why any
+    participant will be skipped
     """
-    This function determines what message a subject will receive
-    based on how many times they've been contacted previously
 
-    Parameters
-        first_name: str | Subject's first name (e.g., "Ian")
-        study_date: str | Date that subject will engage with our research
+    items = plan.loc[:, ITEM_COLUMNS[:-1]].to_dict("records")
+    cohorts = plan.reindex(columns=["cohort"])["cohort"].fillna(DEFAULT_COHORT)
+
+    for item, cohort in zip(items, cohorts):
+        # Plain int, so sqlite3 can bind it (None for frames built by hand)
+        if pd.notna(item["participant_id"]):
+            item["participant_id"] = int(item["participant_id"])
+        else:
+            item["participant_id"] = None
+        if cohort not in get_schedules():
+            item["variable"], item["message"] = None, None
+            item["skip_reason"] = "unknown cohort"
+        elif item["phone_number"] == "MISSING":
+            item["skip_reason"] = "missing number"
+        elif to_e164(item["phone_number"]) is None:
+            item["skip_reason"] = "invalid number"
+        else:
+            item["skip_reason"] = None
+
+    return items
+
+
+def build_plan():
+    """
+    This function computes today's distribution once and stores it, so it
+    can be previewed and then sent without evaluating the schedule again
 
     Returns
-        Long-form string to use as body of SMS text message
+        The new plan's id
     """
 
-    today = datetime.now(pytz.timezone("US/Pacific")).strftime("%m/%d/%Y")
-    time_delta = get_time_delta(study_date=study_date, check_date=today, method="days")
+    started = perf_counter()
+    items = plan_to_items(plan_texts(db_due_today()))
+    elapsed = perf_counter() - started
 
-    # -- Intro text
-    if time_delta == -1:
-        var = "intro_text"
+    return save_plan(
+        DATABASE,
+        items=[tuple(item[key] for key in ITEM_COLUMNS) for item in items],
+        study_date=datetime.now(pytz.timezone("US/Pacific")).date().isoformat(),
+        planning_seconds=elapsed,
+    )
 
-        message = f"""Hi {first_name}!\n
-You have been selected to participate in the Narratives Project! If you are still interested in participating, please read the email we sent you. It might be in your spam folder.\n 
-If you have any questions, call or text us at (650)-223-5997 and we will get back to you as soon as possible.
-        """
 
-    # -- Reminder Day 1
-    elif time_delta == 0:
-        var = "rem1"
+def get_plan(plan_id):
+    """
+    Returns a stored plan with its items, or None
+    """
 
-        message = """Hello!\n
-Hello! This is your reminder that if you would like to participate in the Narratives Project, please click the link we sent to your email and begin the study. Please complete Visits 1 and 2 by Sunday at 11:59pm.\n 
-If you have any questions call or text us at ‪(650) 223-5997‬ and we will get back to you ASAP."""
+    return load_plan(DATABASE, plan_id)
 
-    # -- Reminder Day 2
-    elif time_delta == 2:
-        var = "rem2"
 
-        message = """Hello!\n 
-This is your reminder that today is the last day to complete Visits 1 and 2 of the Narratives Project. Please click the link we sent to your email and begin (or log back in to finish).
-        """
+def start_distribution(plan_id=None, max_workers=8, per_second=1.0, profile=None):
+    """
+    This function submits a distribution as a background job and returns
+    its id straight away; only one distribution runs at a time
 
-    # -- Reminder Day 3
-    elif time_delta == 6:
-        var = "rem3"
+    Parameters
+        plan_id: int | Stored plan to send (a fresh plan is built if None)
+        max_workers: int | Upper bound on sends in flight
+        per_second: float | Account messages-per-second cap
+        profile: callable | Runs the job under a profiler (see utils.profiling)
+
+    Raises
+        JobAlreadyRunning if a distribution is already in progress
+        PlanUnavailable if plan_id can't be sent
+    """
 
-        message = """Hello!\n
-This is your reminder to log back into the website and complete Visit 3 of the Narratives Project. We emailed you the link to log back into the website. Please complete Visit 3 on the day that is 1 week after you completed Visit 2. If you forgot when you completed Visit 2, you can log in to the website and it tells you what day to log back in for Visit 3. \n
-And remember: if you complete all 5 visits you will be entered into a raffle to receive an extra $250 giftcard!        
-        """
+    def study_date():
+        return datetime.now(pytz.timezone("US/Pacific")).date().isoformat()
 
-    # -- Reminder Day 4
-    elif time_delta == 9:
-        var = "rem4"
+    # Fail in the request rather than in the job where we can
+    if plan_id is not None:
+        check_plan(get_plan(plan_id), study_date())
 
-        message = """Hello!\n 
-This is your reminder to log back into the website and complete Visit 3 of the Narratives Project if you have not already done so. We emailed you the link to log back into the website.\n 
-And remember: if you complete all 5 visits you will be entered into a raffle to receive an extra $250 giftcard!
-        """
+    def distribute(job):
+        sending = plan_id if plan_id is not None else build_plan()
+        plan = claim_plan(DATABASE, sending, study_date(), job.job_id)
 
-    # -- Payment Day 1
-    elif time_delta == 11:
-        var = "pay1"
+        try:
+            send_items(
+                items=plan["items"],
+                concurrent=True,
+                max_workers=max_workers,
+                per_second=per_second,
+                progress=job,
+            )
 
-        message = """Hello and thank you for participating in part or all of Visits 1-3.\n 
-We emailed you your giftcard. Visit 4 will happen in a few weeks - we will email and text you to remind you to complete it.\n 
-And remember: if you complete all 5 visits you will be entered into a raffle to receive an extra $250 giftcard! Thanks again!        
-        """
+        except Exception:
+            finish_plan(DATABASE, sending, status="failed")
+            raise
 
-    # -- Reminder Day 5
-    elif time_delta == 29:
-        var = "rem5"
+        finish_plan(DATABASE, sending)
 
-        message = """Hello!\n
-This is your reminder to complete Visit 4 of the Narratives Project. Please complete it on the day that is 1 month after you completed Visit 2. If you forgot when you completed Visit 2, you can log in to the website and it tells you what day to log back in for Visit 4.\n 
-And remember: if you complete all 5 visits you will be entered into a raffle to receive an extra $250 giftcard!
-        """
+    if profile is not None:
+        return run_job(DATABASE, "distribute", lambda job: profile(distribute, job))
 
-    # -- Reminder Day 6
-    elif time_delta == 32:
-        var = "rem6"
+    return run_job(DATABASE, "distribute", distribute)
 
-        message = """Hello!\n 
-This is your reminder to log back into the website and complete Visit 4 of the Narratives Project if you have not already done so. We emailed you the link to log back into the website.\n 
-And remember: if you complete all 5 visits you will be entered into a raffle to receive an extra $250 giftcard!
-        """
 
-    # -- Payment Day 2
-    elif time_delta == 34:
-        var = "pay2"
+def distribution_status(job_id=None):
+    """
+    Returns live counts for a distribution job (the latest one by default)
+    """
 
-        message = """Hello and thank you for participating in part or all of Visit 4.\n
-We emailed you your giftcard. Visit 5 will happen in a few months - we will email and text you to remind you to complete it.\n 
-And remember: if you complete all 5 visits you will be entered into a raffle to receive an extra $250 giftcard!
-        """
+    return job_status(DATABASE, job_id=job_id, kind="distribute")
 
-    # -- Reminder Day 7
-    elif time_delta == 89:
-        var = "rem7"
 
-        message = """Hello!\n 
-This is your reminder to complete Visit 5 of the Narratives Project.  Please complete it on the day that is 3 months after you completed Visit 2. If you forgot when you completed Visit 2, you can log in to the website and it tells you what day to log back in for Visit 5.\n 
-And remember: if you complete all 5 visits you will be entered into a raffle to receive an extra $250 giftcard!
-        """
+def send_one_text(job):
+    """
+    Sends a single text message built by send_texts
 
-    # -- Reminder Day 8
-    elif time_delta == 92:
-        var = "rem8"
+    Parameters
+        job: dict | Contains contact_number (any format) and message keys
 
-        message = """Hello!\n 
-This is your reminder to log back into the website and complete Visit 5 of the Narratives Project if you have not already done so. We emailed you the link to log back into the website.\n 
-And remember: if you complete all 5 visits you will be entered into a raffle to receive an extra $250 giftcard!        
-        """
+    Returns
+        The Twilio message SID
+    """
 
-    # -- Payment Day 3
-    elif time_delta == 94:
-        var = "pay3"
+    with TWILIO_SECONDS.time(operation="send"):
+        return text_transport().send(
+            to=to_e164(job["contact_number"]),
+            from_=twilio_number(),
+            body=job["message"],
+            status_callback=twilio_creds()[3],
+        )
 
-        message = """
-Hello and thank you for participating in part or all of Visit 5. We emailed you your giftcard. Thanks again for participating in the Narratives Project!
-        """
 
-    # -- No need to text!
+def deliver_text(job):
+    """
+    Sends a single text through the outbox: the send is recorded (and
+    committed) first, then marked sent or failed once Twilio answers
+
+    Rows without a participant id (frames built by hand rather than read
+    from the participants table) can't be keyed, and are sent directly
+
+    Raises
+        AlreadySent if this participant already has this slot for today
+    """
+
+    if job["participant_id"] is None:
+        job["sid"] = send_one_text(job)
+        return
+
+    key = (DATABASE, job["participant_id"], job["variable"], job["study_date"])
+
+    claim(*key)
+
+    try:
+        sid = send_one_text(job)
+
+    except Exception as e:
+        fail(*key, error=str(e))
+        raise
+
+    complete(*key, sid=sid)
+    job["sid"] = sid
+
+
+def attempt_text(job):
+    """
+    Sends a single text and returns the exception raised, if any
+    """
+
+    try:
+        deliver_text(job)
+        return None
+
+    except Exception as e:
+        return e
+
+
+def plan_texts(dataframe, today=None):
+    """
+    This function evaluates the texting schedule for every row of the
+    participant frame at once and returns a compact plan of the texts
+    that need to go out
+
+    Parameters
+        dataframe: Pandas DataFrame | Rows from the participants table, with
+                   the sent_slots column added by db_to_dataframe()
+        today: datetime.date | Defaults to the current date in US/Pacific
+
+    Returns
+        DataFrame with participant_id, name, first_name, phone_number, variable,
+        message and cohort columns, one row per text that is due and not yet
+        sent, plus one (with no variable) per participant whose cohort has no
+        schedule, so plan_to_items can flag them
+    """
+
+    columns = [
+        "participant_id",
+        "name",
+        "first_name",
+        "phone_number",
+        "variable",
+        "message",
+        "cohort",
+    ]
+
+    if today is None:
+        today = datetime.now(pytz.timezone("US/Pacific")).date()
+
+    frame = dataframe.reset_index(drop=True)
+
+    if len(frame) == 0:
+        return pd.DataFrame(columns=columns)
+
+    # -- Days between today and each study date (study_day is already ISO)
+    if "study_day" in frame.columns:
+        study = pd.to_datetime(frame["study_day"], format="%Y-%m-%d", errors="coerce")
+    else:
+        study = pd.to_datetime(
+            frame["date_of_study"], format="%m/%d/%Y", errors="coerce"
+        )
+    time_delta = (pd.Timestamp(today) - study).dt.days
+
+    # -- Matched schedule slot per cohort, NaN where nothing is due
+    if "cohort" in frame.columns:
+        cohort = frame["cohort"].fillna(DEFAULT_COHORT)
     else:
+        cohort = pd.Series(DEFAULT_COHORT, index=frame.index)
+
+    variable = pd.Series(np.nan, index=frame.index, dtype=object)
+
+    for name, schedule in get_schedules().items():
+        in_cohort = (cohort == name).to_numpy()
+        variable[in_cohort] = time_delta[in_cohort].map(schedule.offsets)
+
+    # Cohorts without a schedule are kept as well, so they show up as skipped
+    unknown = ~cohort.isin(list(get_schedules())).to_numpy()
+    active = (frame["ignore"] == "False").to_numpy()
+    due = (variable.notna().to_numpy() | unknown) & active
+
+    # -- Already-sent check against each row's sent_slots (from contact_events),
+    # only for the rows that have a slot due today
+    due = np.flatnonzero(due)
+
+    if "sent_slots" in frame.columns:
+        sent_slots = frame["sent_slots"].fillna("").to_numpy()[due]
+        matched = variable.to_numpy()[due]
+        sent = np.array(
+            [slot in done.split(",") for slot, done in zip(matched, sent_slots)],
+            dtype=bool,
+        )
+        due = due[~sent]
+
+    plan = pd.DataFrame(
+        {
+            "participant_id": frame.reindex(columns=["id"])["id"].to_numpy()[due],
+            "name": frame["name"].to_numpy()[due],
+            "phone_number": frame["phone_number"].to_numpy()[due],
+            "variable": variable.to_numpy()[due],
+            "time_delta": time_delta.to_numpy()[due],
+            "cohort": cohort.to_numpy()[due],
+        }
+    )
+
+    # E.g., Ian Ferguson => Ian
+    plan["first_name"] = plan["name"].str.split(" ").str[0].str.title()
+
+    # Bodies are only rendered for the rows that actually get a text
+    plan["message"] = [
+        message_for_offset(time_delta=delta, first_name=first_name, cohort=group)[1]
+        for delta, first_name, group in zip(
+            plan["time_delta"], plan["first_name"], plan["cohort"]
+        )
+    ]
+
+    return plan.loc[:, columns]
+
+
+def message_tree(study_date, first_name, cohort=DEFAULT_COHORT):
+    """
+    This function determines what message a subject will receive
+    based on how many times they've been contacted previously
+
+    Parameters
+        first_name: str | Subject's first name (e.g., "Ian")
+        study_date: str | Date that subject will engage with our research
+        cohort: str | Which schedule the subject follows
+
+    Returns
+        Long-form string to use as body of SMS text message
+    """
+
+    today = datetime.now(pytz.timezone("US/Pacific")).strftime("%m/%d/%Y")
+    time_delta = get_time_delta(study_date=study_date, check_date=today, method="days")
+
+    return message_for_offset(
+        time_delta=time_delta, first_name=first_name, cohort=cohort
+    )
+
+
+def message_for_offset(time_delta, first_name, cohort=DEFAULT_COHORT):
+    """
+    This function returns the message owed to a subject who is time_delta
+    days past their study date
+
+    Parameters
+        time_delta: int | Days between today and the subject's study date
+        first_name: str | Subject's first name (e.g., "Ian")
+        cohort: str | Which schedule the subject follows
+
+    Returns
+        Tuple of (column name, message body), or (None, None) if no text is due
+    """
+
+    schedule = get_schedules().get(cohort)
+
+    if schedule is None:
         return None, None
 
-    return var, message
+    return schedule.message(time_delta=time_delta, first_name=first_name)
 
 
 def get_time_delta(study_date, check_date, method="days"):
@@ -238,39 +722,57 @@ def get_time_delta(study_date, check_date, method="days"):
 
 def sql_init(destroy=False):
     """
-    This function ensures that our local SQL database exists, and it
-    creates the participants table if it doesn't already exist
+    This function ensures that our local SQL database exists, creates the
+    participants table if it doesn't already exist, and applies any pending
+    schema migrations to an existing database
 
     Parameters
         destroy:  Boolean | if True, removes database and recreates it
+
+    Raises
+        JobAlreadyRunning if destroy is True while a distribution is sending
     """
 
-    # -- Case: Database does not exist
-    if not os.path.exists(os.path.join(here, "jm.db")):
-        print("\n** Establishing Database **\n")
+    # -- Case: Database exists and we want to start over
+    if destroy and os.path.exists(DATABASE):
 
-        with sqlite3.connect(os.path.join(here, "jm.db")) as connection:
-            with open(os.path.join(here, "schema.sql")) as script:
-                cursor = connection.cursor()
+        # A sending job holds open connections - don't delete the file under it
+        job_id = active_job(DATABASE, "distribute")
 
-                print("\n** Creating participants table **\n")
-                cursor.executescript(script.read())
+        if job_id is not None:
+            raise JobAlreadyRunning(job_id)
 
-    # -- Case: Database exists and we want to start over
-    if destroy:
+        # The webhook writer owns a connection of its own => flush and stop it first
+        WRITER.close()
+        close_connections(DATABASE)
+
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(DATABASE + suffix):
+                os.remove(DATABASE + suffix)
 
-        os.remove(os.path.join(here, "jm.db"))
         sleep(2)
 
-        with sqlite3.connect(os.path.join(here, "jm.db")) as connection:
+    # -- Case: Database does not exist
+    if not os.path.exists(DATABASE):
+        print("\n** Establishing Database **\n")
+
+        with connect(DATABASE) as connection:
             with open(os.path.join(here, "schema.sql")) as script:
                 cursor = connection.cursor()
 
                 print("\n** Creating participants table **\n")
                 cursor.executescript(script.read())
 
+    # -- Bring schema up to the latest version
+    for version, description in migrate(connect(DATABASE)):
+        print(f"\n** Applied migration {version}: {description} **\n")
+
+    # Reopens the writer against the new file (a no-op if it's already running)
+    WRITER.start()
+
 
-def add_subject_to_db(name, phone_number, study_date):
+@timed(DB_SECONDS)
+def add_subject_to_db(name, phone_number, study_date, cohort=None):
     """
     This function takes HTML input and pushes information to local SQLite database
 
@@ -278,264 +780,511 @@ def add_subject_to_db(name, phone_number, study_date):
         name: str | Subject's full name
         phone_number: str | Subject's contact number
         study_date: str | Date that subject will engage with our research
+        cohort: str | Which schedule the subject follows (None keeps the stored one)
     """
 
-    with sqlite3.connect(os.path.join(here, "jm.db")) as connection:
+    number = clean_number(phone_number)
+
+    with connect(DATABASE) as connection:
         cursor = connection.cursor()
 
         cursor.execute(
             f"""
-            INSERT INTO participants (name,phone_number,date_of_study)
-            VALUES (?,?,?)
+            INSERT INTO participants
+             (name,phone_number,phone_key,date_of_study,study_day,cohort)
+            VALUES (?,?,?,?,?,COALESCE(?,
+             (SELECT cohort FROM participants WHERE name = ? AND phone_number = ?),
+             ?))
+            ON CONFLICT (name, phone_number) DO UPDATE SET
+             phone_key = excluded.phone_key,
+             date_of_study = excluded.date_of_study,
+             study_day = excluded.study_day,
+             cohort = excluded.cohort
             """,
-            (name, phone_number, study_date),
+            (
+                name,
+                number,
+                phone_key(phone_number),
+                study_date,
+                to_study_day(study_date),
+                cohort,
+                name,
+                number,
+                DEFAULT_COHORT,
+            ),
         )
 
 
+@timed(DB_SECONDS)
 def ignore_participant(full_name, contact_number):
     """
     This function updates subject's row in DB so that they are not sent any additional texts
 
     Parameters
         full_name: str | Subject's full name
-        contact_number: str | Subject's contact number
+        contact_number: str | Subject's contact number, in any format
+
+    Returns
+        Number of participants updated
     """
 
-    with sqlite3.connect(os.path.join(here, "jm.db")) as connection:
+    match, number = number_match(contact_number)
+
+    with connect(DATABASE) as connection:
         cursor = connection.cursor()
 
         cursor.execute(
-            """
+            f"""
         UPDATE participants
         SET ignore = (?)
-        WHERE name = (?) AND phone_number = (?)
+        WHERE name = (?) AND {match}
         """,
-            (True, full_name, contact_number),
+            (True, full_name, number),
         )
 
+        return cursor.rowcount
+
+
+# Participant rows plus a comma-separated list of the slots they've been sent
+PARTICIPANT_SQL = """
+SELECT id, name, phone_number, phone_key, date_of_study, study_day, cohort, ignore,
+ (SELECT group_concat(slot) FROM contact_events
+  WHERE participant_id = participants.id) AS sent_slots
+FROM participants
+"""
+
 
+@timed(DB_SECONDS)
 def db_to_dataframe():
     """
     This function pulls down all information from our participants table
     and converts it to a Pandas DataFrame
     """
 
-    with sqlite3.connect(os.path.join(here, "jm.db")) as connection:
-        return pd.read_sql("SELECT * FROM participants", connection)
+    with connect(DATABASE) as connection:
+        return pd.read_sql(PARTICIPANT_SQL, connection)
 
 
-def get_texts(sent_by_me=False):
+@timed(DB_SECONDS)
+def db_due_today():
     """
-    This function aggregates all sent or received texts, based on Boolean parameter
+    This function asks the database for participants who are owed a text
+    today: not ignored, study_day matches one of the schedule offsets, and
+    there is no contact event for that offset's slot yet. Participants whose
+    cohort has no schedule are returned too, so the plan can flag them
+
+    Returns a DataFrame in the same shape as db_to_dataframe()
     """
 
-    # -- Empty DF to append into
-    output = pd.DataFrame()
+    today = datetime.now(pytz.timezone("US/Pacific")).date()
 
-    # -- All texts sent to subjects
-    if sent_by_me:
+    schedules = get_schedules()
 
-        for text in API.messages.stream(from_=TWIL_number):
-            temp = pd.DataFrame(
-                {"date": text.date_created, "sent_to": text.to, "body": text.body},
-                index=[0],
+    clauses = [f"cohort NOT IN ({', '.join('?' for _ in schedules)})"]
+    params = list(schedules)
+
+    for cohort, schedule in schedules.items():
+        for offset, variable in schedule.offsets.items():
+            clauses.append(
+                """(study_day = ? AND cohort = ? AND NOT EXISTS (
+                 SELECT 1 FROM contact_events
+                 WHERE participant_id = participants.id AND slot = ?))"""
+            )
+            params.extend(
+                [(today - timedelta(days=offset)).isoformat(), cohort, variable]
             )
 
-            output = output.append(temp, ignore_index=True)
+    sql = f"""
+    {PARTICIPANT_SQL}
+    WHERE ignore = 'False' AND ({" OR ".join(clauses)})
+    """
+
+    with connect(DATABASE) as connection:
+        return pd.read_sql(sql, connection, params=params)
+
+
+@timed(DB_SECONDS)
+def read_messages(select, where, params, limit=None, start=None, end=None):
+    """
+    This function reads texts from the local message mirror, newest first
+
+    Parameters
+        select: str | Columns to return
+        where: list | SQL conditions, all of which must hold
+        params: list | Values for the placeholders in where
+        limit: int | Maximum number of texts to return
+        start: datetime | Only texts sent on or after this date
+        end: datetime | Only texts sent before this date
+    """
+
+    where, params = list(where), list(params)
+
+    if start is not None:
+        where.append("date_created >= ?")
+        params.append(to_utc_string(start))
+
+    if end is not None:
+        where.append("date_created < ?")
+        params.append(to_utc_string(end))
+
+    sql = f"""
+    SELECT {select} FROM messages
+    WHERE {" AND ".join(where)}
+    ORDER BY date_created DESC, sid
+    """
+
+    if limit is not None:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+
+    with connect(DATABASE) as connection:
+        return pd.read_sql(sql, connection, params=params)
+
+
+def get_texts(sent_by_me=False, limit=None, start=None, end=None):
+    """
+    This function aggregates all sent or received texts, based on Boolean parameter,
+    from the local message mirror (synced with Twilio first if it's stale)
+
+    Parameters
+        sent_by_me: Boolean | if True, texts we sent; otherwise texts we received
+        limit: int | Maximum number of texts to return
+        start: datetime | Only texts sent on or after this date
+        end: datetime | Only texts sent before this date
+    """
+
+    sync_message_log()
+
+    # -- All texts sent to subjects
+    if sent_by_me:
+        select = "date_created AS date, to_number AS sent_to, body"
+        where = ["from_number = ?"]
 
     # -- All texts sent to this number
     else:
+        select = "date_created AS date, from_number AS sent_from, body"
+        where = ["to_number = ?"]
 
-        for text in API.messages.stream(to=TWIL_number):
-            temp = pd.DataFrame(
-                {"date": text.date_created, "sent_from": text.from_, "body": text.body},
-                index=[0],
-            )
+    return read_messages(
+        select, where, [twilio_number()], limit=limit, start=start, end=end
+    )
+
+
+def get_twilio_errors(limit=None, start=None, end=None):
+    """
+    Creates dataframe of undelivered and failed texts from the local message mirror
+
+    Parameters
+        limit: int | Maximum number of texts to return
+        start: datetime | Only texts sent on or after this date
+        end: datetime | Only texts sent before this date
+    """
+
+    sync_message_log()
+
+    return read_messages(
+        'COALESCE(date_sent, status_updated) AS date, to_number AS "to", body',
+        [UNDELIVERED],
+        [],
+        limit=limit,
+        start=start,
+        end=end,
+    )
+
+
+def invalidate_message_cache():
+    """
+    Forces the next sync to go back to the Twilio API
+    """
 
-            output = output.append(temp, ignore_index=True)
+    MESSAGE_CACHE.invalidate()
 
-    if len(output) == 0:
-        return pd.DataFrame(columns=["date", "sent_from", "body"])
 
-    return output.reset_index(drop=True)
+def sync_message_log(ttl=None):
+    """
+    This function pulls any Twilio messages newer than our stored watermark
+    into the local messages table, at most once per TTL window
 
+    Parameters
+        ttl: float | Seconds before another sync is allowed (default MESSAGE_CACHE_TTL)
 
-def get_twilio_errors():
+    Returns
+        Number of messages pulled by the most recent sync
     """
-    Creates dataframe of underlivered texts
+
+    ttl = MESSAGE_CACHE_TTL if ttl is None else ttl
+
+    def sync():
+        with TWILIO_SECONDS.time(operation="sync"), connect(DATABASE) as connection:
+            return sync_messages(transport=text_transport(), connection=connection)
+
+    return MESSAGE_CACHE.get("sync", ttl, sync)
+
+
+def record_message_status(sid, status, error_code=None, to=None, from_=None):
     """
+    This function queues a delivery-status callback for the background writer,
+    so the webhook can answer Twilio without waiting on SQLite
 
-    output = {}
-    m = 0
+    Parameters
+        sid: str | Twilio message SID
+        status: str | E.g., sent, delivered, undelivered
+        error_code: int | Twilio error code, if the message failed
+        to: str | Recipient number
+        from_: str | Sending number
+    """
 
-    for k in API.messages.stream():
+    now = datetime.now(pytz.utc).strftime("%Y-%m-%d %H:%M:%S")
 
-        if k.status == "undelivered":
+    WRITER.submit(
+        STATUS_CALLBACK_SQL,
+        (sid, from_, to, status, error_code, now, now),
+    )
 
-            temp = {"date": k.date_sent, "to": k.to, "body": k.body}
 
-            output[m] = temp
-            m += 1
+def record_inbound_text(sid, from_, to, body):
+    """
+    This function queues an incoming text for the background writer, so the
+    /sms webhook can reply immediately even when many participants answer
+    a blast at once
+
+    Parameters
+        sid: str | Twilio message SID
+        from_: str | Participant's number
+        to: str | Our Twilio number
+        body: str | Text of the message
+    """
+
+    now = datetime.now(pytz.utc).strftime("%Y-%m-%d %H:%M:%S")
 
-    if m == 0:
-        return pd.DataFrame(columns=["date", "to", "body"])
+    WRITER.submit(INBOUND_SQL, (sid, from_, to, body, now, now))
 
-    return pd.DataFrame(output).T
+
+def log_query(view, sort=None, order=None, after=None, search=None):
+    """
+    This function builds the keyset query behind one of the LOG_VIEWS
+
+    Parameters
+        view: str | Key into LOG_VIEWS
+        sort: str | One of the view's sortable keys (defaults to the first)
+        order: str | "asc" or "desc" (defaults to the view's natural order)
+        after: str | Cursor returned with the previous page
+        search: str | Free-text filter applied to the view's search clause
+
+    Returns
+        Tuple of (sql, params)
+    """
+
+    spec = LOG_VIEWS[view]
+
+    # Sort expressions come from LOG_VIEWS, never from user input
+    sort_column = spec["sort"].get(sort, next(iter(spec["sort"].values())))
+    descending = (order or spec["order"]) == "desc"
+
+    where, params = list(spec.get("where", [])), []
+
+    if "owner" in spec:
+        where.append(f"{spec['owner']} = ?")
+        params.append(twilio_number())
+
+    if search:
+        where.append(spec["search"])
+        params.extend([f"%{search.strip()}%"] * spec["search"].count("?"))
+
+    return keyset_query(
+        select=spec["select"],
+        table=spec["table"],
+        sort=sort_column,
+        tiebreak=spec["tiebreak"],
+        where=where,
+        params=params,
+        descending=descending,
+        after=decode_cursor(after),
+    )
+
+
+@timed(DB_SECONDS)
+def log_page(view, per_page=100, **options):
+    """
+    Returns (columns, rows, next cursor) for one page of a log view
+    """
+
+    sql, params = log_query(view, **options)
+
+    with connect(DATABASE) as connection:
+        return fetch_page(connection, sql, params, per_page=per_page)
+
+
+def stream_log(view, **options):
+    """
+    Returns (columns, row generator) covering every row of a log view;
+    rows are read from SQLite lazily as the response is sent
+    """
+
+    sql, params = log_query(view, **options)
+    connection = connect(DATABASE)
+
+    description = connection.execute(f"{sql} LIMIT 0", params).description
+    columns = [column[0] for column in description][:-2]
+
+    return columns, iter_rows(connection, sql, params)
 
 
 def update_contact_date(variable_name, full_name, contact_number, new_date):
     """
-    This function updates the contact information in our participants table
+    This function records that a subject has been sent a slot's text,
     which informs the messaging that subjects will receive in future texts
 
     Parameters
-        variable_name: str | Column name in SQL database
+        variable_name: str | Schedule slot (e.g., "rem1")
         full_name: str | Subject's full name
         contact_number: str | Subject's phone number
         new_date: str | Today's date, in practice
     """
 
-    with sqlite3.connect(os.path.join(here, "jm.db")) as connection:
-        cursor = connection.cursor()
+    with ContactDateWriter(new_date=new_date) as writer:
+        writer.add(
+            variable_name=variable_name,
+            full_name=full_name,
+            contact_number=contact_number,
+        )
 
-        if variable_name == "intro_text":
-            cursor.execute(
-                """
-            UPDATE participants
-            SET intro_text = (?)
-            WHERE name = (?) AND phone_number = (?);
-            """,
-                (new_date, full_name, contact_number),
-            )
 
-        elif variable_name == "rem1":
-            cursor.execute(
-                """
-            UPDATE participants
-            SET rem1 = (?)
-            WHERE name = (?) AND phone_number = (?);
-            """,
-                (new_date, full_name, contact_number),
-            )
+class ContactDateWriter:
+    def __init__(self, new_date, checkpoint=250):
+        """
+        Collects contact events during a distribution run and writes them
+        to contact_events in batches, one transaction per batch
 
-        elif variable_name == "rem2":
-            cursor.execute(
-                """
-            UPDATE participants
-            SET rem2 = (?)
-            WHERE name = (?) AND phone_number = (?);
-            """,
-                (new_date, full_name, contact_number),
-            )
+        Parameters
+            new_date: str | When the texts went out, in practice
+            checkpoint: int | Pending events that trigger a flush (a crash loses few)
+        """
 
-        elif variable_name == "rem3":
-            cursor.execute(
-                """
-            UPDATE participants
-            SET rem3 = (?)
-            WHERE name = (?) AND phone_number = (?);
-            """,
-                (new_date, full_name, contact_number),
-            )
+        self.new_date = new_date
+        self.checkpoint = checkpoint
+        self.pending = []
+        self.connection = None
 
-        elif variable_name == "rem4":
-            cursor.execute(
-                """
-            UPDATE participants
-            SET rem4 = (?)
-            WHERE name = (?) AND phone_number = (?);
-            """,
-                (new_date, full_name, contact_number),
-            )
+    def __enter__(self):
+        self.connection = connect(DATABASE)
+        return self
 
-        elif variable_name == "pay1":
-            cursor.execute(
-                """
-            UPDATE participants
-            SET pay1 = (?)
-            WHERE name = (?) AND phone_number = (?);
-            """,
-                (new_date, full_name, contact_number),
-            )
+    def __exit__(self, *exc):
+        try:
+            self.flush()
+        finally:
+            self.connection = None
 
-        elif variable_name == "rem5":
-            cursor.execute(
-                """
-            UPDATE participants
-            SET rem5 = (?)
-            WHERE name = (?) AND phone_number = (?);
-            """,
-                (new_date, full_name, contact_number),
-            )
+    def add(
+        self, variable_name, full_name, contact_number, participant_id=None, sid=None
+    ):
+        """
+        Queues a single contact event
+
+        Parameters
+            variable_name: str | Schedule slot that was sent
+            full_name: str | Subject's full name
+            contact_number: str | Subject's phone number
+            participant_id: int | Row id, when known (saves the name lookup)
+            sid: str | Twilio message SID
+        """
 
-        elif variable_name == "rem6":
-            cursor.execute(
-                """
-            UPDATE participants
-            SET rem6 = (?)
-            WHERE name = (?) AND phone_number = (?);
-            """,
-                (new_date, full_name, contact_number),
+        if variable_name not in schedule_slots():
+            raise ValueError(f"{variable_name} is not a schedule slot")
+
+        self.pending.append(
+            (
+                variable_name,
+                self.new_date,
+                sid,
+                participant_id,
+                full_name,
+                contact_number,
             )
+        )
 
-        elif variable_name == "pay2":
-            cursor.execute(
-                """
-            UPDATE participants
-            SET pay2 = (?)
-            WHERE name = (?) AND phone_number = (?);
-            """,
-                (new_date, full_name, contact_number),
-            )
+        if len(self.pending) >= self.checkpoint:
+            self.flush()
 
-        elif variable_name == "rem7":
-            cursor.execute(
-                """
-            UPDATE participants
-            SET rem7 = (?)
-            WHERE name = (?) AND phone_number = (?);
-            """,
-                (new_date, full_name, contact_number),
-            )
+    @timed(DB_SECONDS)
+    def flush(self):
+        """
+        Writes every queued event inside a single transaction; a slot that
+        was already recorded for a participant keeps its first event
+        """
 
-        elif variable_name == "rem8":
-            cursor.execute(
-                """
-            UPDATE participants
-            SET rem8 = (?)
-            WHERE name = (?) AND phone_number = (?);
-            """,
-                (new_date, full_name, contact_number),
-            )
+        if not self.pending:
+            return
 
-        elif variable_name == "pay3":
-            cursor.execute(
+        with self.connection:
+            self.connection.executemany(
                 """
-            UPDATE participants
-            SET pay3 = (?)
-            WHERE name = (?) AND phone_number = (?);
-            """,
-                (new_date, full_name, contact_number),
+                INSERT INTO contact_events (participant_id, slot, sent_at, sid)
+                SELECT id, ?, ?, ? FROM participants
+                WHERE id = COALESCE(?, (
+                 SELECT id FROM participants WHERE name = ? AND phone_number = ?
+                ))
+                ON CONFLICT (participant_id, slot) DO NOTHING;
+                """,
+                self.pending,
             )
 
+        self.pending = []
 
+
+def schedule_slots():
+    """
+    Returns every slot named by any cohort's schedule
+    """
+
+    return {
+        slot
+        for schedule in get_schedules().values()
+        for slot in schedule.offsets.values()
+    }
+
+
+@timed(DB_SECONDS)
+def participant_history(participant_id):
+    """
+    Returns a DataFrame of every text a participant has been sent, oldest first
+    """
+
+    sql = """
+    SELECT slot, sent_at, sid FROM contact_events
+    WHERE participant_id = ? ORDER BY sent_at, id
+    """
+
+    with connect(DATABASE) as connection:
+        return pd.read_sql(sql, connection, params=(int(participant_id),))
+
+
+@timed(DB_SECONDS)
 def update_contact_number(name, old_number, new_number):
     """
-    Updates contact information in SQL database
+    Updates contact information in SQL database (old_number may be in any format)
+
+    Returns
+        Number of participants updated
     """
 
-    with sqlite3.connect(os.path.join(here, "jm.db")) as connect:
-        cursor = connect.cursor()
+    match, number = number_match(old_number)
+
+    with connect(DATABASE) as connection:
+        cursor = connection.cursor()
 
         cursor.execute(
-            """
+            f"""
         UPDATE participants
-        SET phone_number = (?)
-        WHERE name = (?) AND phone_number = (?);
+        SET phone_number = (?), phone_key = (?)
+        WHERE name = (?) AND {match};
         """,
-            (new_number, name, old_number),
+            (clean_number(new_number), phone_key(new_number), name, number),
         )
 
+        return cursor.rowcount
+
 
 def test_twilio_wrapper(name: str = "Ian"):
     """
@@ -550,15 +1299,22 @@ def test_twilio_wrapper(name: str = "Ian"):
 
     message = "Sup big dog, this is a test of the automated Just Mercy text system"
 
-    API.messages.create(to=number, from_=TWIL_number, body=message)
+    text_transport().send(to=number, from_=twilio_number(), body=message)
 
 
+@timed(DB_SECONDS)
 def easy_lookup(contact_number: str):
     """
-    Return DataFrame of individuals who match contact_number
+    Return DataFrame of individuals who match contact_number, in any format
+    (see participant_history for the texts each one has been sent)
     """
 
-    sql = f"""select * from participants where phone_number = {contact_number}"""
+    match, number = number_match(contact_number)
+
+    sql = f"""
+    SELECT id, name, phone_number, date_of_study, cohort, ignore
+    FROM participants WHERE {match}
+    """
 
-    with sqlite3.connect(os.path.join(here, "jm.db")) as conn:
-        return pd.read_sql(sql=sql, con=conn)
+    with connect(DATABASE) as connection:
+        return pd.read_sql(sql=sql, con=connection, params=(number,))
@@ -0,0 +1,178 @@
+#!/bin/python3
+
+"""
+Local mirror of our Twilio message history
+
+sync_messages() pulls only the messages sent since the stored watermark and
+upserts them into the messages table, so the log pages can read from local
+disk instead of paging through the whole account on every load. The
+transport is passed in, so any object exposing stream(...) (see
+utils/transport.py) can stand in for the Twilio API
+"""
+
+from datetime import datetime, timedelta, timezone
+
+
+##########
+
+
+WATERMARK = "messages_date_sent"
+
+# Inbound texts arrive through the /sms webhook before any sync sees them
+INBOUND_SQL = """
+INSERT INTO messages
+(sid,direction,from_number,to_number,body,status,date_created,date_sent)
+VALUES (?,'inbound',?,?,?,'received',?,?)
+ON CONFLICT (sid) DO NOTHING;
+"""
+
+# Statuses a message can't leave once it reaches them
+FINAL_STATUSES = ("delivered", "undelivered", "failed", "received", "read")
+
+# Delivery-status callbacks can arrive out of order, so a late "sent" never
+# overwrites a final status that has already been recorded
+STATUS_CALLBACK_SQL = f"""
+INSERT INTO messages
+(sid,direction,from_number,to_number,status,error_code,date_created,status_updated)
+VALUES (?,'outbound-api',?,?,?,?,?,?)
+ON CONFLICT (sid) DO UPDATE SET
+ status = CASE
+  WHEN messages.status IN {FINAL_STATUSES}
+   AND excluded.status NOT IN {FINAL_STATUSES}
+  THEN messages.status ELSE excluded.status END,
+ error_code = COALESCE(excluded.error_code, messages.error_code),
+ status_updated = excluded.status_updated;
+"""
+
+
+def to_utc_string(value):
+    """
+    Formats a Twilio timestamp as a sortable UTC string (None stays None)
+    """
+
+    if value is None:
+        return None
+
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return value.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def get_watermark(connection):
+    """
+    Returns the latest date_sent we've mirrored, or None before the first sync
+    """
+
+    row = connection.execute(
+        "SELECT value FROM sync_state WHERE name = (?)", (WATERMARK,)
+    ).fetchone()
+
+    return row[0] if row else None
+
+
+def message_record(message):
+    """
+    Flattens a Twilio message instance into a row for the messages table
+    """
+
+    return (
+        message.sid,
+        message.direction,
+        message.from_,
+        message.to,
+        message.body,
+        message.status,
+        message.error_code,
+        to_utc_string(message.date_created),
+        to_utc_string(message.date_sent),
+    )
+
+
+def store_messages(connection, records):
+    """
+    Upserts message rows keyed by SID, so re-pulled messages pick up
+    their latest status instead of being duplicated, and rows first seen
+    through a status callback get their body and timestamps filled in.
+    As with callbacks, a final status is never replaced by an earlier one
+    (the API can lag behind a callback that has already arrived)
+    """
+
+    connection.executemany(
+        f"""
+        INSERT INTO messages
+        (sid,direction,from_number,to_number,body,status,error_code,
+         date_created,date_sent)
+        VALUES (?,?,?,?,?,?,?,?,?)
+        ON CONFLICT (sid) DO UPDATE SET
+         direction = excluded.direction,
+         body = excluded.body,
+         status = CASE
+          WHEN messages.status IN {FINAL_STATUSES}
+           AND excluded.status NOT IN {FINAL_STATUSES}
+          THEN messages.status ELSE excluded.status END,
+         error_code = COALESCE(excluded.error_code, messages.error_code),
+         date_created = excluded.date_created,
+         date_sent = COALESCE(excluded.date_sent, messages.date_sent);
+        """,
+        records,
+    )
+
+
+def sync_messages(transport, connection, batch_size=500):
+    """
+    This function mirrors every message sent since the stored watermark
+    into the local messages table
+
+    Twilio filters on the day a message was sent, so we pull again from the
+    day before the watermark; the SID upsert makes that overlap harmless
+
+    Parameters
+        transport: Transport | Exposes stream(...), like utils.transport's
+        connection: sqlite3.Connection | Open connection to jm.db
+        batch_size: int | Rows written per transaction
+
+    Returns
+        Number of messages pulled from the API
+    """
+
+    watermark = get_watermark(connection)
+
+    if watermark is None:
+        stream = transport.stream(page_size=batch_size)
+    else:
+        since = datetime.strptime(watermark, "%Y-%m-%d %H:%M:%S")
+        stream = transport.stream(
+            date_sent_after=since - timedelta(days=1), page_size=batch_size
+        )
+
+    pulled, latest, batch = 0, watermark, []
+
+    for message in stream:
+        record = message_record(message)
+        batch.append(record)
+        pulled += 1
+
+        date_sent = record[-1]
+        if date_sent is not None and (latest is None or date_sent > latest):
+            latest = date_sent
+
+        if len(batch) >= batch_size:
+            with connection:
+                store_messages(connection, batch)
+            batch = []
+
+    # Twilio streams newest first, so only move the watermark once the walk is done
+    with connection:
+        store_messages(connection, batch)
+
+        if latest is not None:
+            connection.execute(
+                """
+                INSERT INTO sync_state (name, value) VALUES (?,?)
+                ON CONFLICT (name) DO UPDATE SET value = excluded.value;
+                """,
+                (WATERMARK, latest),
+            )
+
+    return pulled
@@ -0,0 +1,259 @@
+#!/bin/python3
+
+"""
+Background distribution jobs
+
+A distribution run is recorded in the jobs table and executed on a worker
+thread, so /distribute can return immediately. The job row doubles as a
+lock: a new job is only created when no other job has sent a heartbeat
+recently, which also holds across several web worker processes
+"""
+
+import json, sqlite3, threading
+from datetime import datetime, timedelta
+from time import monotonic
+from utils.connection import connect
+
+
+##########
+
+
+# A running job that hasn't saved progress for this long is presumed dead
+STALE_AFTER = timedelta(minutes=5)
+
+# Most problem messages kept on a job row
+MAX_MESSAGES = 500
+
+
+class JobAlreadyRunning(Exception):
+    def __init__(self, job_id):
+        super().__init__(f"Distribution job {job_id} is already running")
+        self.job_id = job_id
+
+
+def timestamp(value=None):
+    return (value or datetime.now()).isoformat(timespec="milliseconds")
+
+
+class Job:
+    def __init__(self, job_id: int, database_path: str, save_every: float = 1.0):
+        """
+        Live progress of one distribution run
+
+        send_texts calls start / sent / skipped / failed as it goes; counts
+        are kept in memory and written to the jobs table at most once per
+        save_every seconds, plus once when the job finishes
+
+        Parameters
+            job_id: int | Row id in the jobs table
+            database_path: str | Path to jm.db
+            save_every: float | Seconds between progress writes
+        """
+
+        self.job_id = job_id
+        self.database_path = database_path
+        self.save_every = save_every
+        self.counts = {"total": 0, "sent": 0, "skipped": 0, "failed": 0}
+        self.messages = []
+        self.lock = threading.Lock()
+        self.last_save = monotonic()
+
+    def start(self, total):
+        with self.lock:
+            self.counts["total"] = total
+
+        self.save(force=True)
+
+    def sent(self):
+        self.bump("sent")
+
+    def skipped(self, message):
+        self.bump("skipped", message)
+
+    def failed(self, message):
+        self.bump("failed", message)
+
+    def bump(self, key, message=None):
+        with self.lock:
+            self.counts[key] += 1
+
+            if message is not None and len(self.messages) < MAX_MESSAGES:
+                self.messages.append(message)
+
+        self.save()
+
+    def save(self, status=None, force=False):
+        """
+        Writes counts (and optionally a new status) to the job row
+        """
+
+        recent = monotonic() - self.last_save < self.save_every
+
+        if not force and status is None and recent:
+            return
+
+        with self.lock:
+            counts = dict(self.counts)
+            messages = json.dumps(self.messages)
+            self.last_save = monotonic()
+
+        fields = {**counts, "messages": messages, "updated_at": timestamp()}
+
+        if status is not None:
+            fields["status"] = status
+
+            if status in ("done", "failed"):
+                fields["finished_at"] = fields["updated_at"]
+
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+
+        with connect(self.database_path) as connection:
+            connection.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ?",
+                [*fields.values(), self.job_id],
+            )
+
+
+def active_job(database_path: str, kind: str):
+    """
+    Returns the id of a job of kind that has sent a heartbeat recently,
+    or None if nothing is running
+    """
+
+    cutoff = timestamp(datetime.now() - STALE_AFTER)
+
+    try:
+        row = connect(database_path).execute(
+            """
+            SELECT id FROM jobs
+            WHERE kind = ? AND status IN ('queued', 'running') AND updated_at > ?
+            ORDER BY id DESC LIMIT 1;
+            """,
+            (kind, cutoff),
+        ).fetchone()
+
+    # Databases from before the jobs table can't have a job running
+    except sqlite3.OperationalError:
+        return None
+
+    return row[0] if row else None
+
+
+def create_job(database_path: str, kind: str):
+    """
+    This function claims the single distribution slot and records a new job
+
+    Raises
+        JobAlreadyRunning if another job has sent a heartbeat recently
+    """
+
+    connection = connect(database_path)
+    now = datetime.now()
+
+    # BEGIN IMMEDIATE takes the write lock, so two workers can't both claim the slot
+    connection.execute("BEGIN IMMEDIATE")
+
+    try:
+        running = connection.execute(
+            """
+            SELECT id, updated_at FROM jobs
+            WHERE kind = ? AND status IN ('queued', 'running')
+            ORDER BY id DESC;
+            """,
+            (kind,),
+        ).fetchall()
+
+        for job_id, updated_at in running:
+
+            if datetime.fromisoformat(updated_at) > now - STALE_AFTER:
+                raise JobAlreadyRunning(job_id)
+
+            connection.execute(
+                "UPDATE jobs SET status = 'failed', finished_at = ? WHERE id = ?",
+                (timestamp(now), job_id),
+            )
+
+        cursor = connection.execute(
+            """
+            INSERT INTO jobs (kind, status, created_at, updated_at)
+            VALUES (?, 'queued', ?, ?);
+            """,
+            (kind, timestamp(now), timestamp(now)),
+        )
+
+        connection.commit()
+
+    except Exception:
+        connection.rollback()
+        raise
+
+    return cursor.lastrowid
+
+
+def run_job(database_path: str, kind: str, target):
+    """
+    Creates a job and runs target(job) on a background thread
+
+    Parameters
+        database_path: str | Path to jm.db
+        kind: str | Job type - only one job of each kind runs at a time
+        target: callable | Receives the Job and does the work
+
+    Returns
+        The new job's id
+    """
+
+    job = Job(create_job(database_path, kind), database_path)
+
+    def work():
+        job.save(status="running")
+
+        try:
+            target(job)
+            job.save(status="done")
+
+        except Exception as e:
+            with job.lock:
+                job.messages.append(f"Job stopped: {e}")
+
+            job.save(status="failed")
+
+    threading.Thread(target=work, name=f"jm-job-{job.job_id}", daemon=True).start()
+
+    return job.job_id
+
+
+def job_status(database_path: str, job_id: int = None, kind: str = None):
+    """
+    Returns a job row as a dictionary (the latest job of kind if no id is
+    given), including the send rate in messages per second
+
+    Returns
+        Dictionary, or None if no such job exists
+    """
+
+    connection = connect(database_path)
+
+    if job_id is not None:
+        cursor = connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+    else:
+        cursor = connection.execute(
+            "SELECT * FROM jobs WHERE kind = ? ORDER BY id DESC LIMIT 1", (kind,)
+        )
+
+    row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    job = dict(zip([column[0] for column in cursor.description], row))
+    job["messages"] = json.loads(job["messages"] or "[]")
+
+    # Rate over the time the job has actually been sending
+    started = datetime.fromisoformat(job["created_at"])
+    ended = datetime.fromisoformat(job["finished_at"] or job["updated_at"])
+    elapsed = max((ended - started).total_seconds(), 1e-3)
+
+    job["rate"] = round(job["sent"] / elapsed, 2) if job["sent"] else 0.0
+
+    return job
@@ -0,0 +1,35 @@
+#!/bin/python3
+import importlib, threading
+
+
+##########
+
+
+class LazyModule:
+    def __init__(self, name: str):
+        """
+        Stand-in for a heavy module (e.g., pandas) that is only imported the
+        first time one of its attributes is used
+
+        Parameters
+            name: str | Dotted module name passed to importlib
+        """
+
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                self._module = importlib.import_module(self._name)
+
+        return self._module
+
+    def __getattr__(self, attribute):
+        module = self._module if self._module is not None else self._load()
+        return getattr(module, attribute)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
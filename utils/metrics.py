@@ -0,0 +1,225 @@
+#!/bin/python3
+
+"""
+In-process metrics in the Prometheus text exposition format
+
+Counters and histograms are plain Python objects guarded by a lock each;
+recording a value is a dictionary lookup and a few additions, so they stay
+on in production. render() produces the body served at /metrics. Values
+live in the process that recorded them - with several web workers, each
+worker reports its own series
+"""
+
+import threading
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+
+
+##########
+
+
+# Upper bounds (seconds) for latency histograms
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REGISTRY = []
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        """
+        Monotonic count, kept separately for each combination of label values
+
+        Parameters
+            name: str | Metric name, e.g., jm_messages_total
+            documentation: str | HELP text
+            labels: tuple | Label names, passed as keywords to inc()
+        """
+
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+
+        for key, value in sorted(values.items()):
+            yield self.name, dict(zip(self.labels, key)), value
+
+    def kind(self):
+        return "counter"
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple = (),
+        buckets: tuple = LATENCY_BUCKETS,
+    ):
+        """
+        Distribution of observed values (latencies, in practice) in
+        cumulative buckets, plus their sum and count
+
+        Parameters
+            name: str | Metric name, e.g., jm_request_seconds
+            documentation: str | HELP text
+            labels: tuple | Label names, passed as keywords to observe()
+            buckets: tuple | Sorted bucket upper bounds (+Inf is implied)
+        """
+
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self.lock = threading.Lock()
+
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(label, "")) for label in self.labels)
+        slot = bisect_left(self.buckets, value)
+
+        with self.lock:
+            series = self.values.get(key)
+
+            if series is None:
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+            series[0][slot] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, **labels):
+        """
+        Context manager that observes the seconds spent inside the block
+        """
+
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(s[0]), s[1], s[2]) for key, s in self.values.items()}
+
+        bounds = [format_value(bound) for bound in self.buckets] + ["+Inf"]
+
+        for key, (counts, total, count) in sorted(values.items()):
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+
+            for bound, bucket in zip(bounds, counts):
+                cumulative += bucket
+                yield f"{self.name}_bucket", {**labels, "le": bound}, cumulative
+
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+    def kind(self):
+        return "histogram"
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.started, **self.labels)
+
+
+def timed(histogram, label: str = "function"):
+    """
+    Decorator that records each call's duration in histogram, labelled
+    with the function's name
+    """
+
+    def decorate(function):
+        labels = {label: function.__qualname__}
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with Timer(histogram, labels):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def format_value(value):
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
+
+
+def escape(value: str):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render():
+    """
+    This function returns every registered metric in the Prometheus text
+    exposition format (version 0.0.4)
+    """
+
+    lines = []
+
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {escape(metric.documentation)}")
+        lines.append(f"# TYPE {metric.name} {metric.kind()}")
+
+        for name, labels, value in metric.samples():
+
+            if labels:
+                pairs = ",".join(f'{key}="{escape(v)}"' for key, v in labels.items())
+                name = f"{name}{{{pairs}}}"
+
+            lines.append(f"{name} {format_value(value)}")
+
+    return "\n".join(lines) + "\n"
+
+
+#####
+
+
+MESSAGES = Counter(
+    "jm_messages_total",
+    "Texts handled by distribution runs, by schedule slot and outcome",
+    labels=("slot", "outcome"),
+)
+
+TWILIO_SECONDS = Histogram(
+    "jm_twilio_request_seconds",
+    "Time spent in calls to the text transport (Twilio in production)",
+    labels=("operation",),
+)
+
+DB_SECONDS = Histogram(
+    "jm_db_query_seconds",
+    "Time spent in helper functions that query SQLite",
+    labels=("function",),
+)
+
+REQUEST_SECONDS = Histogram(
+    "jm_request_seconds",
+    "Flask request duration until the response is returned (streamed bodies excluded)",
+    labels=("route", "method", "status"),
+)
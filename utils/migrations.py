@@ -0,0 +1,534 @@
+#!/bin/python3
+
+"""
+Versioned upgrades to jm.db
+
+schema.sql describes version 0 of the database. Each entry in MIGRATIONS
+moves the schema forward by one version, and migrate() applies every
+entry that an existing database hasn't seen yet, in order, recording
+each one in the schema_version table
+"""
+
+from datetime import datetime
+from utils.dates import to_study_day
+from utils.phone import phone_key
+from utils.schedule import DEFAULT_COHORT
+
+
+##########
+
+
+# One TEXT column per message slot in schema.sql - superseded by contact_events
+MARKER_COLUMNS = ["intro_text", "rem1", "rem2", "rem3", "rem4", "pay1"]
+MARKER_COLUMNS += ["rem5", "rem6", "pay2", "rem7", "rem8", "pay3"]
+
+
+def backfill_study_day(cursor):
+    """
+    Populates study_day for participants added before the column existed
+    """
+
+    rows = cursor.execute("SELECT id, date_of_study FROM participants").fetchall()
+
+    cursor.executemany(
+        "UPDATE participants SET study_day = (?) WHERE id = (?);",
+        [(to_study_day(study_date), row_id) for row_id, study_date in rows],
+    )
+
+
+def merge_duplicate_participants(cursor):
+    """
+    Collapses participants who share a (name, phone_number) pair onto the
+    oldest row, keeping every sent marker and any ignore flag
+    """
+
+    same = "p.name = participants.name AND p.phone_number = participants.phone_number"
+
+    merged = [
+        f"""{column} = (SELECT COALESCE(MAX(p.{column}), '')
+        FROM participants p WHERE {same})"""
+        for column in MARKER_COLUMNS
+    ]
+    merged.append(
+        f"""ignore = (SELECT CASE WHEN SUM(p.ignore != 'False') > 0 THEN '1'
+        ELSE 'False' END FROM participants p WHERE {same})"""
+    )
+
+    cursor.execute(
+        f"""
+        UPDATE participants SET {", ".join(merged)}
+        WHERE id IN (
+         SELECT MIN(id) FROM participants
+         GROUP BY name, phone_number HAVING COUNT(*) > 1
+        );
+        """
+    )
+
+    cursor.execute(
+        """
+        DELETE FROM participants WHERE id NOT IN (
+         SELECT MIN(id) FROM participants GROUP BY name, phone_number
+        );
+        """
+    )
+
+
+def backfill_contact_events(cursor):
+    """
+    Copies every filled-in marker column into contact_events, one row per
+    participant and slot (dates become ISO where they can be parsed)
+    """
+
+    for column in MARKER_COLUMNS:
+        rows = cursor.execute(
+            f"""
+            SELECT id, {column} FROM participants
+            WHERE COALESCE({column}, '') != '';
+            """
+        ).fetchall()
+
+        cursor.executemany(
+            """
+            INSERT INTO contact_events (participant_id, slot, sent_at)
+            VALUES (?,?,?)
+            ON CONFLICT (participant_id, slot) DO NOTHING;
+            """,
+            [
+                (row_id, column, to_study_day(sent) or sent)
+                for row_id, sent in rows
+            ],
+        )
+
+
+def backfill_phone_key(cursor):
+    """
+    Populates phone_key (E.164 digits) for participants added before it existed
+    """
+
+    rows = cursor.execute("SELECT id, phone_number FROM participants").fetchall()
+
+    cursor.executemany(
+        "UPDATE participants SET phone_key = (?) WHERE id = (?);",
+        [(phone_key(number), row_id) for row_id, number in rows],
+    )
+
+
+def merge_same_phone_key(cursor):
+    """
+    Collapses participants who share a name and phone_key (one person
+    imported in several number formats) onto the oldest row, moving their
+    contact events, outbox entries and plan items across and keeping any
+    ignore flag
+    """
+
+    cursor.execute(
+        """
+        CREATE TEMP TABLE merges AS
+        SELECT id AS duplicate, (
+         SELECT MIN(id) FROM participants p
+         WHERE p.name = participants.name AND p.phone_key = participants.phone_key
+        ) AS survivor
+        FROM participants WHERE phone_key IS NOT NULL;
+        """
+    )
+    cursor.execute("DELETE FROM merges WHERE duplicate = survivor;")
+
+    cursor.execute(
+        """
+        UPDATE participants SET ignore = '1'
+        WHERE id IN (
+         SELECT survivor FROM merges
+         JOIN participants p ON p.id = merges.duplicate
+         WHERE p.ignore != 'False'
+        );
+        """
+    )
+
+    # Slots both rows were sent keep the survivor's record
+    for table in ("contact_events", "outbox", "plan_items"):
+        cursor.execute(
+            f"""
+            UPDATE OR IGNORE {table}
+            SET participant_id = (
+             SELECT survivor FROM merges WHERE duplicate = {table}.participant_id
+            )
+            WHERE participant_id IN (SELECT duplicate FROM merges);
+            """
+        )
+        cursor.execute(
+            f"""
+            DELETE FROM {table}
+            WHERE participant_id IN (SELECT duplicate FROM merges);
+            """
+        )
+
+    cursor.execute(
+        "DELETE FROM participants WHERE id IN (SELECT duplicate FROM merges);"
+    )
+    cursor.execute("DROP TABLE merges;")
+
+
+def drop_marker_columns(cursor):
+    """
+    Rebuilds participants without the marker columns, which contact_events
+    replaced in migration 10 (SQLite can't drop columns in place before 3.35)
+    """
+
+    columns = "id, name, phone_number, phone_key, date_of_study, study_day"
+    columns += ", cohort, ignore"
+
+    # AUTOINCREMENT's high-water mark, so ids of merged-away rows aren't reused
+    sequence = cursor.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'participants';"
+    ).fetchone()
+
+    cursor.execute(
+        f"""
+        CREATE TABLE participants_new (
+         id INTEGER PRIMARY KEY AUTOINCREMENT,
+         name TEXT NOT NULL,
+         phone_number TEXT NOT NULL,
+         phone_key INTEGER,
+         date_of_study DATETIME NOT NULL,
+         study_day TEXT,
+         cohort TEXT NOT NULL DEFAULT '{DEFAULT_COHORT}',
+         ignore TEXT DEFAULT 'False'
+        );
+        """
+    )
+    cursor.execute(
+        f"INSERT INTO participants_new ({columns}) SELECT {columns} FROM participants;"
+    )
+    cursor.execute("DROP TABLE participants;")
+    cursor.execute("ALTER TABLE participants_new RENAME TO participants;")
+
+    if sequence is not None:
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'participants';")
+        cursor.execute(
+            "INSERT INTO sqlite_sequence (name, seq) VALUES ('participants', ?);",
+            sequence,
+        )
+
+
+MIGRATIONS = [
+    (
+        1,
+        "Index participants by name / phone number",
+        [
+            """
+            CREATE INDEX IF NOT EXISTS idx_participants_name_phone
+            ON participants (name, phone_number);
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_participants_phone
+            ON participants (phone_number);
+            """,
+        ],
+    ),
+    (
+        2,
+        "Store an indexed ISO study_day for SQL-side scheduling",
+        [
+            "ALTER TABLE participants ADD COLUMN study_day TEXT;",
+            backfill_study_day,
+            """
+            CREATE INDEX IF NOT EXISTS idx_participants_study_day
+            ON participants (study_day);
+            """,
+        ],
+    ),
+    (
+        3,
+        "Assign each participant to a schedule cohort",
+        [
+            f"""
+            ALTER TABLE participants
+            ADD COLUMN cohort TEXT NOT NULL DEFAULT '{DEFAULT_COHORT}';
+            """,
+        ],
+    ),
+    (
+        4,
+        "Mirror Twilio message history locally",
+        [
+            """
+            CREATE TABLE messages (
+             sid TEXT PRIMARY KEY,
+             direction TEXT,
+             from_number TEXT,
+             to_number TEXT,
+             body TEXT,
+             status TEXT,
+             error_code INTEGER,
+             date_created TEXT,
+             date_sent TEXT
+            );
+            """,
+            """
+            CREATE INDEX idx_messages_from_date
+            ON messages (from_number, date_created);
+            """,
+            """
+            CREATE INDEX idx_messages_to_date
+            ON messages (to_number, date_created);
+            """,
+            """
+            CREATE INDEX idx_messages_status
+            ON messages (status);
+            """,
+            """
+            CREATE TABLE sync_state (
+             name TEXT PRIMARY KEY,
+             value TEXT
+            );
+            """,
+        ],
+    ),
+    (
+        5,
+        "Track when delivery-status callbacks last touched a message",
+        [
+            "ALTER TABLE messages ADD COLUMN status_updated TEXT;",
+        ],
+    ),
+    (
+        6,
+        "Make (name, phone_number) unique so roster imports can upsert",
+        [
+            merge_duplicate_participants,
+            "DROP INDEX IF EXISTS idx_participants_name_phone;",
+            """
+            CREATE UNIQUE INDEX idx_participants_name_phone
+            ON participants (name, phone_number);
+            """,
+        ],
+    ),
+    (
+        7,
+        "Track background distribution jobs",
+        [
+            """
+            CREATE TABLE jobs (
+             id INTEGER PRIMARY KEY AUTOINCREMENT,
+             kind TEXT NOT NULL,
+             status TEXT NOT NULL,
+             created_at TEXT NOT NULL,
+             updated_at TEXT NOT NULL,
+             finished_at TEXT,
+             total INTEGER NOT NULL DEFAULT 0,
+             sent INTEGER NOT NULL DEFAULT 0,
+             skipped INTEGER NOT NULL DEFAULT 0,
+             failed INTEGER NOT NULL DEFAULT 0,
+             messages TEXT
+            );
+            """,
+            """
+            CREATE INDEX idx_jobs_kind_status
+            ON jobs (kind, status);
+            """,
+        ],
+    ),
+    (
+        8,
+        "Store distribution plans for preview before sending",
+        [
+            """
+            CREATE TABLE plans (
+             id INTEGER PRIMARY KEY AUTOINCREMENT,
+             study_date TEXT NOT NULL,
+             status TEXT NOT NULL,
+             created_at TEXT NOT NULL,
+             planning_ms REAL,
+             total INTEGER NOT NULL DEFAULT 0,
+             skipped INTEGER NOT NULL DEFAULT 0,
+             job_id INTEGER REFERENCES jobs (id)
+            );
+            """,
+            """
+            CREATE TABLE plan_items (
+             plan_id INTEGER NOT NULL REFERENCES plans (id),
+             position INTEGER NOT NULL,
+             name TEXT,
+             first_name TEXT,
+             phone_number TEXT,
+             variable TEXT,
+             message TEXT,
+             skip_reason TEXT,
+             PRIMARY KEY (plan_id, position)
+            );
+            """,
+        ],
+    ),
+    (
+        9,
+        "Write-ahead outbox so an interrupted distribution never sends twice",
+        [
+            """
+            CREATE TABLE outbox (
+             participant_id INTEGER NOT NULL,
+             slot TEXT NOT NULL,
+             study_date TEXT NOT NULL,
+             status TEXT NOT NULL,
+             attempts INTEGER NOT NULL DEFAULT 0,
+             sid TEXT,
+             error TEXT,
+             updated_at TEXT NOT NULL,
+             PRIMARY KEY (participant_id, slot, study_date)
+            );
+            """,
+            """
+            CREATE INDEX idx_outbox_date_status
+            ON outbox (study_date, status);
+            """,
+            "ALTER TABLE plan_items ADD COLUMN participant_id INTEGER;",
+        ],
+    ),
+    (
+        10,
+        "Record sent texts as contact_events rather than one column per slot",
+        [
+            """
+            CREATE TABLE contact_events (
+             id INTEGER PRIMARY KEY AUTOINCREMENT,
+             participant_id INTEGER NOT NULL REFERENCES participants (id),
+             slot TEXT NOT NULL,
+             sent_at TEXT NOT NULL,
+             sid TEXT
+            );
+            """,
+            # Answers both "was this slot sent?" and "what has this participant had?"
+            """
+            CREATE UNIQUE INDEX idx_contact_events_participant_slot
+            ON contact_events (participant_id, slot);
+            """,
+            backfill_contact_events,
+        ],
+    ),
+    (
+        11,
+        "Key participants by their E.164 phone number for exact lookups",
+        [
+            "ALTER TABLE participants ADD COLUMN phone_key INTEGER;",
+            backfill_phone_key,
+            """
+            CREATE INDEX idx_participants_phone_key
+            ON participants (phone_key);
+            """,
+        ],
+    ),
+    (
+        12,
+        "Store phone numbers as E.164 and merge participants who share one",
+        [
+            merge_same_phone_key,
+            """
+            UPDATE participants SET phone_number = '+' || phone_key
+            WHERE phone_key IS NOT NULL;
+            """,
+        ],
+    ),
+    (
+        13,
+        "Drop the intro_text..pay3 marker columns superseded by contact_events",
+        [
+            drop_marker_columns,
+            # Dropping the old table dropped its indexes too
+            """
+            CREATE UNIQUE INDEX idx_participants_name_phone
+            ON participants (name, phone_number);
+            """,
+            """
+            CREATE INDEX idx_participants_phone
+            ON participants (phone_number);
+            """,
+            """
+            CREATE INDEX idx_participants_study_day
+            ON participants (study_day);
+            """,
+            """
+            CREATE INDEX idx_participants_phone_key
+            ON participants (phone_key);
+            """,
+        ],
+    ),
+]
+
+
+def current_version(connection):
+    """
+    Returns the most recent migration applied to this database (0 if none)
+    """
+
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_version (
+         version INTEGER PRIMARY KEY,
+         description TEXT NOT NULL,
+         applied_at TEXT NOT NULL
+        );
+        """
+    )
+
+    version = connection.execute("SELECT MAX(version) FROM schema_version").fetchone()
+
+    return version[0] or 0
+
+
+def migrate(connection):
+    """
+    This function upgrades an existing database in place, applying each
+    pending migration inside its own transaction
+
+    Each transaction takes the write lock up front (BEGIN IMMEDIATE) and
+    re-reads the version under it, so when several processes start at once
+    only the first applies a migration and the rest skip it
+
+    Parameters
+        connection: sqlite3.Connection | Open connection to jm.db
+
+    Returns
+        List of (version, description) tuples that were applied
+    """
+
+    applied = []
+    version = current_version(connection)
+
+    for number, description, steps in MIGRATIONS:
+
+        if number <= version:
+            continue
+
+        cursor = connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+
+        try:
+            # Another process may have applied it while we waited for the lock
+            if number <= current_version(connection):
+                connection.rollback()
+                continue
+
+            for step in steps:
+
+                # Steps are either raw SQL or a callable that receives the cursor
+                if callable(step):
+                    step(cursor)
+                else:
+                    cursor.execute(step)
+
+            cursor.execute(
+                """
+                INSERT INTO schema_version (version, description, applied_at)
+                VALUES (?,?,?);
+                """,
+                (number, description, datetime.now().isoformat(timespec="seconds")),
+            )
+
+            connection.commit()
+
+        except Exception:
+            connection.rollback()
+            raise
+
+        applied.append((number, description))
+
+    return applied
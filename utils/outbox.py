@@ -0,0 +1,113 @@
+#!/bin/python3
+
+"""
+Write-ahead outbox for distribution runs
+
+Every text is claimed in the outbox table - keyed by (participant, slot,
+study date) - and committed before it is handed to Twilio, then marked sent
+(with its SID) or failed afterwards. If a run dies part way through, the next
+run skips everything already sent instead of texting those participants again.
+A row left "pending" belongs to a send that was cut off mid-flight; we can't
+tell whether Twilio accepted it, so it is never retried automatically
+"""
+
+from datetime import datetime
+from utils.connection import connect
+
+
+##########
+
+
+class AlreadySent(Exception):
+    def __init__(self, status):
+        """
+        Raised instead of sending when the outbox already holds this text
+
+        Parameters
+            status: str | "sent", or "pending" for an interrupted send
+        """
+
+        if status == "sent":
+            reason = "already sent today"
+        else:
+            reason = "an earlier send was interrupted - check Outgoing Texts"
+
+        super().__init__(reason)
+        self.status = status
+
+
+def timestamp():
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def claim(database_path: str, participant_id: int, slot: str, study_date: str):
+    """
+    This function records that a text is about to be sent and commits it
+
+    A failed attempt can be claimed again; a pending or sent one can't
+
+    Raises
+        AlreadySent if the text is already pending or sent
+    """
+
+    with connect(database_path) as connection:
+        claimed = connection.execute(
+            """
+            INSERT INTO outbox
+             (participant_id, slot, study_date, status, attempts, updated_at)
+            VALUES (?, ?, ?, 'pending', 1, ?)
+            ON CONFLICT (participant_id, slot, study_date) DO UPDATE SET
+             status = 'pending',
+             attempts = outbox.attempts + 1,
+             error = NULL,
+             updated_at = excluded.updated_at
+            WHERE outbox.status = 'failed';
+            """,
+            (participant_id, slot, study_date, timestamp()),
+        ).rowcount
+
+        if claimed:
+            return
+
+        (status,) = connection.execute(
+            """
+            SELECT status FROM outbox
+            WHERE participant_id = ? AND slot = ? AND study_date = ?;
+            """,
+            (participant_id, slot, study_date),
+        ).fetchone()
+
+    raise AlreadySent(status)
+
+
+def complete(
+    database_path: str, participant_id: int, slot: str, study_date: str, sid=None
+):
+    """
+    Marks a claimed text as accepted by Twilio
+    """
+
+    settle(database_path, participant_id, slot, study_date, "sent", sid=sid)
+
+
+def fail(
+    database_path: str, participant_id: int, slot: str, study_date: str, error=None
+):
+    """
+    Marks a claimed text as failed, so a later run may try it again
+    """
+
+    settle(database_path, participant_id, slot, study_date, "failed", error=error)
+
+
+def settle(
+    database_path, participant_id, slot, study_date, status, sid=None, error=None
+):
+    with connect(database_path) as connection:
+        connection.execute(
+            """
+            UPDATE outbox SET status = ?, sid = ?, error = ?, updated_at = ?
+            WHERE participant_id = ? AND slot = ? AND study_date = ?;
+            """,
+            (status, sid, error, timestamp(), participant_id, slot, study_date),
+        )
@@ -0,0 +1,125 @@
+#!/bin/python3
+
+"""
+Keyset pagination over SQLite tables
+
+Instead of OFFSET (which rescans every skipped row), each page asks for
+rows strictly after the last (sort value, tiebreak) pair the reader saw.
+That pair is handed to the browser as an opaque cursor, so every page is
+an index seek regardless of how deep into the log the reader is
+"""
+
+import base64, json
+
+
+##########
+
+
+def encode_cursor(values):
+    """
+    Packs the last row's (sort value, tiebreak) into a URL-safe token
+    """
+
+    raw = json.dumps(list(values)).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    """
+    Reverses encode_cursor; returns None for a missing or malformed token
+    """
+
+    if not token:
+        return None
+
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except ValueError:
+        return None
+
+    if not isinstance(values, list) or len(values) != 2:
+        return None
+
+    return values
+
+
+def keyset_query(
+    select, table, sort, tiebreak, where=None, params=(), descending=True, after=None
+):
+    """
+    This function builds a keyset-paginated SELECT
+
+    The sort and tiebreak expressions are appended as the final two columns
+    of every row, so the caller can build the next cursor from the last row
+
+    Parameters
+        select: str | Column list for the SELECT clause
+        table: str | Table to read from
+        sort: str | Expression rows are ordered by
+        tiebreak: str | Unique column that breaks ties in sort
+        where: list | SQL conditions joined with AND
+        params: tuple | Values bound to the conditions in where
+        descending: Boolean | Newest / largest first when True
+        after: list | Decoded cursor of the last row already shown
+
+    Returns
+        Tuple of (sql, params)
+    """
+
+    where = list(where or [])
+    params = list(params)
+
+    if after is not None:
+        where.append(f"({sort}, {tiebreak}) {'<' if descending else '>'} (?, ?)")
+        params.extend(after)
+
+    direction = "DESC" if descending else "ASC"
+
+    sql = f"SELECT {select}, {sort}, {tiebreak} FROM {table}"
+
+    if where:
+        sql += " WHERE " + " AND ".join(f"({clause})" for clause in where)
+
+    sql += f" ORDER BY {sort} {direction}, {tiebreak} {direction}"
+
+    return sql, params
+
+
+def fetch_page(connection, sql, params, per_page=100):
+    """
+    Runs a keyset query and returns one page of rows
+
+    Returns
+        Tuple of (column names, rows, cursor for the next page or None)
+    """
+
+    cursor = connection.execute(f"{sql} LIMIT ?", [*params, per_page + 1])
+    columns = [column[0] for column in cursor.description][:-2]
+    rows = cursor.fetchall()
+
+    next_cursor = None
+
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1][-2:])
+
+    return columns, [row[:-2] for row in rows], next_cursor
+
+
+def iter_rows(connection, sql, params, batch_size=500):
+    """
+    Yields rows of a keyset query a batch at a time, so a streamed response
+    can start sending before the last row has been read
+    """
+
+    cursor = connection.execute(sql, params)
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+
+        if not rows:
+            return
+
+        for row in rows:
+            yield row[:-2]
@@ -0,0 +1,149 @@
+#!/bin/python3
+
+"""
+Phone number normalization
+
+Rosters arrive with numbers in every format (650-223-5997, (650) 223 5997,
++16502235997, 6502235997.0 from Excel, "MISSING"). Everything that stores,
+sends to or matches a number goes through these functions, which reduce it
+to E.164 (+16502235997) - the format Twilio uses in its message logs - or
+None if the number can't be dialled. Numbers without a country code are
+taken to be North American
+
+participants.phone_number holds the E.164 form (or the text as entered, if
+it can't be dialled), and participants.phone_key the E.164 digits as an
+integer (16502235997), so lookups and joins against the message log are
+exact index hits
+"""
+
+import re
+from functools import lru_cache
+
+
+##########
+
+
+# Anything that isn't a digit - separators, spaces, letters
+NON_DIGITS = re.compile(r"\D")
+
+# Numeric spreadsheet cells come through as floats, e.g., 6502235997.0
+FLOAT_SUFFIX = re.compile(r"\.0+$")
+
+
+@lru_cache(maxsize=65536)
+def to_e164(number):
+    """
+    This function converts a phone number to E.164
+
+    Parameters
+        number: str | Phone number in any common format
+
+    Returns
+        E.164 string (e.g., "+16502235997"), or None if it isn't a valid number
+    """
+
+    if number is None:
+        return None
+
+    text = FLOAT_SUFFIX.sub("", str(number).strip())
+    international = text.startswith("+")
+    digits = NON_DIGITS.sub("", text)
+
+    if international:
+        if 8 <= len(digits) <= 15 and digits[0] != "0":
+            return f"+{digits}"
+
+    elif len(digits) == 10 and digits[0] in "23456789":
+        return f"+1{digits}"
+
+    elif len(digits) == 11 and digits[0] == "1" and digits[1] in "23456789":
+        return f"+{digits}"
+
+    return None
+
+
+def phone_key(number):
+    """
+    Integer key for participants.phone_key (None if number isn't valid)
+    """
+
+    e164 = to_e164(number)
+
+    return int(e164[1:]) if e164 is not None else None
+
+
+def clean_number(number):
+    """
+    The form stored in participants.phone_number - E.164 where possible,
+    otherwise the text as entered (e.g., "MISSING")
+    """
+
+    return to_e164(number) or str(number).strip()
+
+
+def number_match(number):
+    """
+    This function returns a WHERE clause and parameter matching
+    participants with this phone number, in any format
+
+    Returns
+        Tuple of (sql, param)
+    """
+
+    key = phone_key(number)
+
+    # Undiallable entries (e.g., "MISSING") can only be matched as typed
+    if key is None:
+        return "phone_number = ?", str(number).strip()
+
+    return "phone_key = ?", key
+
+
+def to_e164_series(numbers):
+    """
+    This function is the vectorized to_e164, for whole roster columns
+
+    Parameters
+        numbers: Pandas Series | Phone numbers in any common format
+
+    Returns
+        Series of E.164 strings, with None where a number isn't valid
+    """
+
+    text = numbers.astype(str).str.strip().str.replace(FLOAT_SUFFIX, "", regex=True)
+    international = text.str.startswith("+")
+    digits = text.str.replace(NON_DIGITS, "", regex=True)
+    length = digits.str.len()
+
+    plus = international & length.between(8, 15) & ~digits.str.startswith("0")
+    local = ~international & (length == 10) & digits.str.match(r"[2-9]")
+    trunk = ~international & (length == 11) & digits.str.match(r"1[2-9]")
+
+    e164 = ("+1" + digits).where(local, "+" + digits).astype(object)
+
+    # Missing cells (None / NaN) stringify to "None" / "nan" and fail every rule
+    return e164.where(plus | local | trunk, None)
+
+
+def clean_numbers(numbers):
+    """
+    Vectorized clean_number
+    """
+
+    e164 = to_e164_series(numbers)
+
+    return e164.where(e164.notna(), numbers.astype(str).str.strip())
+
+
+def phone_keys(numbers):
+    """
+    Vectorized phone_key - Series of Python ints, with None where invalid
+    """
+
+    e164 = to_e164_series(numbers)
+    valid = e164.notna()
+
+    keys = e164.copy()
+    keys[valid] = [int(number[1:]) for number in e164[valid]]
+
+    return keys
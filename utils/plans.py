@@ -0,0 +1,165 @@
+#!/bin/python3
+
+"""
+Stored distribution plans
+
+A plan is the list of texts due on one study date - who, which slot, the
+rendered body, or why the participant will be skipped - computed once and
+saved to the plans / plan_items tables. The preview page reads it back, and
+sending executes the saved rows as-is rather than evaluating the schedule again
+"""
+
+from datetime import datetime
+from utils.connection import connect
+
+
+##########
+
+
+# Stored per item, in this order
+ITEM_COLUMNS = [
+    "participant_id",
+    "name",
+    "first_name",
+    "phone_number",
+    "variable",
+    "message",
+    "skip_reason",
+]
+
+
+class PlanUnavailable(Exception):
+    """
+    Raised when a plan can't be sent (unknown, already sent, or out of date)
+    """
+
+
+def save_plan(database_path: str, items, study_date: str, planning_seconds: float):
+    """
+    This function stores a freshly computed plan and supersedes any plan for
+    the same day that hasn't been sent, so only the newest preview can be sent
+
+    Parameters
+        database_path: str | Path to jm.db
+        items: iterable | Tuples in ITEM_COLUMNS order
+        study_date: str | ISO date the plan was computed for
+        planning_seconds: float | Time taken to compute the plan
+
+    Returns
+        The new plan's id
+    """
+
+    items = list(items)
+
+    with connect(database_path) as connection:
+        connection.execute(
+            "UPDATE plans SET status = 'superseded' WHERE status = 'ready';"
+        )
+
+        plan_id = connection.execute(
+            """
+            INSERT INTO plans
+             (study_date, status, created_at, planning_ms, total, skipped)
+            VALUES (?, 'ready', ?, ?, ?, ?);
+            """,
+            (
+                study_date,
+                datetime.now().isoformat(timespec="seconds"),
+                round(planning_seconds * 1000, 1),
+                len(items),
+                sum(1 for item in items if item[-1]),
+            ),
+        ).lastrowid
+
+        connection.executemany(
+            f"""
+            INSERT INTO plan_items (plan_id, position, {", ".join(ITEM_COLUMNS)})
+            VALUES (?, ?, {", ".join("?" for _ in ITEM_COLUMNS)});
+            """,
+            ((plan_id, position, *item) for position, item in enumerate(items)),
+        )
+
+    return plan_id
+
+
+def load_plan(database_path: str, plan_id: int):
+    """
+    Returns a plan row as a dictionary with its items under "items", or None
+    """
+
+    connection = connect(database_path)
+
+    cursor = connection.execute("SELECT * FROM plans WHERE id = ?", (plan_id,))
+    row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    plan = dict(zip([column[0] for column in cursor.description], row))
+
+    plan["items"] = [
+        dict(zip(ITEM_COLUMNS, item))
+        for item in connection.execute(
+            f"""
+            SELECT {", ".join(ITEM_COLUMNS)} FROM plan_items
+            WHERE plan_id = ? ORDER BY position;
+            """,
+            (plan_id,),
+        )
+    ]
+
+    return plan
+
+
+def check_plan(plan, study_date: str):
+    """
+    Raises PlanUnavailable unless plan can still be sent on study_date
+    """
+
+    if plan is None:
+        raise PlanUnavailable("That plan doesn't exist")
+
+    if plan["status"] != "ready":
+        raise PlanUnavailable(f"Plan {plan['id']} has already been {plan['status']}")
+
+    # Offsets are counted from the day the plan was made
+    if plan["study_date"] != study_date:
+        raise PlanUnavailable(
+            f"Plan {plan['id']} was made for {plan['study_date']} - preview again"
+        )
+
+
+def claim_plan(database_path: str, plan_id: int, study_date: str, job_id: int):
+    """
+    This function marks a ready plan as sending under job_id; only one
+    caller can claim a given plan
+
+    Returns
+        The plan dictionary, with items
+
+    Raises
+        PlanUnavailable if the plan is unknown, stale or already claimed
+    """
+
+    check_plan(load_plan(database_path, plan_id), study_date)
+
+    with connect(database_path) as connection:
+        claimed = connection.execute(
+            """
+            UPDATE plans SET status = 'sending', job_id = ?
+            WHERE id = ? AND status = 'ready';
+            """,
+            (job_id, plan_id),
+        ).rowcount
+
+    if not claimed:
+        raise PlanUnavailable(f"Plan {plan_id} is already being sent")
+
+    return load_plan(database_path, plan_id)
+
+
+def finish_plan(database_path: str, plan_id: int, status: str = "sent"):
+    with connect(database_path) as connection:
+        connection.execute(
+            "UPDATE plans SET status = ? WHERE id = ?;", (status, plan_id)
+        )
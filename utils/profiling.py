@@ -0,0 +1,200 @@
+#!/bin/python3
+
+"""
+Opt-in request profiling
+
+A Profile wraps a block of work (one Flask request, or a distribution job
+and the worker threads it starts) in cProfile and, optionally, a stack
+sampler. When it is saved, it writes three files under the profile folder:
+
+    <stamp>-<label>.prof       pstats dump, sortable with pstats or snakeviz
+    <stamp>-<label>.txt        top functions by cumulative time
+    <stamp>-<label>.collapsed  sampled stacks, one "a;b;c count" line each,
+                               ready for flamegraph.pl / speedscope
+"""
+
+import cProfile, io, os, pstats, re, sys, threading
+from collections import Counter
+from datetime import datetime
+from time import perf_counter
+
+
+##########
+
+
+class Profile:
+    def __init__(
+        self,
+        directory: str,
+        label: str,
+        collapsed=False,
+        threads=False,
+        interval=0.005,
+    ):
+        """
+        Profiles the calling thread between start() and stop()
+
+        Parameters
+            directory: str | Folder the profile files are written to
+            label: str | Names the files, e.g., "GET-outgoing_texts"
+            collapsed: Boolean | Also sample stacks for a flamegraph
+            threads: Boolean | Also profile threads started meanwhile (send pools)
+            interval: float | Seconds between stack samples
+        """
+
+        self.directory = directory
+        self.label = re.sub(r"[^A-Za-z0-9_.-]+", "_", label).strip("_") or "request"
+        self.collapsed = collapsed
+        self.threads = threads
+        self.interval = interval
+        self.profiler = cProfile.Profile()
+        self.workers = []
+        self.lock = threading.Lock()
+        self.stacks = Counter()
+        self.running = threading.Event()
+        self.sampler = None
+        self.elapsed = 0.0
+
+    def start(self):
+        """
+        Starts profiling; returns False if another profiler is already active
+        """
+
+        try:
+            self.profiler.enable()
+        except ValueError:
+            return False
+
+        self.started = perf_counter()
+
+        if self.collapsed:
+            self.running.set()
+            self.sampler = threading.Thread(
+                target=self.sample,
+                args=(threading.get_ident(),),
+                name="jm-profile-sampler",
+                daemon=True,
+            )
+            self.sampler.start()
+
+        # Every thread started from here on gets its own profiler, merged on save
+        # (any thread in the process, so other requests can show up too)
+        if self.threads:
+            threading.setprofile(self.thread_started)
+
+        return True
+
+    def thread_started(self, frame, event, arg):
+        """
+        First profile event in a new thread - swaps in a cProfile for it
+        """
+
+        profiler = cProfile.Profile()
+
+        try:
+            profiler.enable()
+
+        # Python 3.12+ profiles every thread with the first profiler already
+        except ValueError:
+            sys.setprofile(None)
+            return
+
+        with self.lock:
+            self.workers.append((threading.get_ident(), profiler))
+
+    def stop(self):
+        self.profiler.disable()
+        self.elapsed = perf_counter() - self.started
+
+        if self.threads:
+            threading.setprofile(None)
+
+        if self.sampler is not None:
+            self.running.clear()
+            self.sampler.join()
+
+        return self.elapsed
+
+    def sample(self, thread_id):
+        """
+        Records the profiled threads' stacks every interval seconds
+        """
+
+        while self.running.is_set():
+            frames = sys._current_frames()
+
+            with self.lock:
+                threads = [thread_id] + [ident for ident, _ in self.workers]
+
+            for ident in threads:
+                frame = frames.get(ident)
+                stack = []
+
+                while frame is not None:
+                    code = frame.f_code
+                    where = os.path.basename(code.co_filename)
+                    stack.append(f"{code.co_name} ({where}:{code.co_firstlineno})")
+                    frame = frame.f_back
+
+                if stack:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+            self.running.wait(self.interval)
+
+    def save(self):
+        """
+        Writes the profile files
+
+        Returns
+            Path of the .prof file
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        base = os.path.join(self.directory, f"{stamp}-{self.label}")
+
+        report = io.StringIO()
+        report.write(f"{self.label}: {self.elapsed:.3f} s")
+        report.write(f" ({len(self.workers)} worker threads merged)\n\n")
+
+        stats = pstats.Stats(self.profiler, stream=report)
+
+        # Worker threads have finished by now (their pools shut down inside the block)
+        for _, profiler in self.workers:
+            stats.add(profiler)
+
+        stats.dump_stats(f"{base}.prof")
+        stats.sort_stats("cumulative").print_stats(40)
+
+        with open(f"{base}.txt", "w") as outgoing:
+            outgoing.write(report.getvalue())
+
+        if self.collapsed:
+            with open(f"{base}.collapsed", "w") as outgoing:
+                for stack, count in self.stacks.most_common():
+                    outgoing.write(f"{stack} {count}\n")
+
+        return f"{base}.prof"
+
+
+def profiled(directory: str, label: str, collapsed=False):
+    """
+    Returns a function that runs target() under a Profile and always saves it,
+    for work that happens outside a request (e.g., a distribution job, whose
+    sends run on dispatch's worker threads)
+    """
+
+    def run(target, *args, **kwargs):
+        profile = Profile(directory, label, collapsed=collapsed, threads=True)
+        active = profile.start()
+
+        try:
+            return target(*args, **kwargs)
+
+        finally:
+            if active:
+                profile.stop()
+                profile.save()
+
+    return run
@@ -0,0 +1,92 @@
+#!/bin/python3
+import json, os
+
+
+##########
+
+
+# Cohort assigned to participants who weren't given one explicitly
+DEFAULT_COHORT = "narratives"
+
+
+class Schedule:
+    def __init__(self, cohort: str, slots: list, description: str = ""):
+        """
+        Compiled texting schedule for a single study / cohort
+
+        Parameters
+            cohort: str | Name stored in the participants.cohort column
+            slots: list | Dicts with offset, slot and template keys
+            description: str | Human-readable summary of the schedule
+        """
+
+        self.cohort = cohort
+        self.description = description
+
+        # Offset-indexed lookup => (slot, template)
+        self.by_offset = {}
+
+        for entry in slots:
+            offset = int(entry["offset"])
+
+            if offset in self.by_offset:
+                raise ValueError(f"{cohort} schedule has two slots on day {offset}")
+
+            self.by_offset[offset] = (entry["slot"], entry["template"])
+
+        # Offset => slot, used for vectorized planning and SQL selection
+        self.offsets = {k: v[0] for k, v in self.by_offset.items()}
+
+    def message(self, time_delta, first_name):
+        """
+        Returns (slot, rendered message) for a subject time_delta days
+        past their study date, or (None, None) if no text is due
+        """
+
+        entry = self.by_offset.get(time_delta)
+
+        if entry is None:
+            return None, None
+
+        slot, template = entry
+
+        return slot, template.format(first_name=first_name)
+
+
+def load_schedules(directory: os.path):
+    """
+    This function reads every *.json schedule definition in directory and
+    compiles each one into a Schedule keyed by cohort name
+
+    Parameters
+        directory: os.path | Folder holding schedule definitions
+
+    Returns
+        Dictionary of cohort name => Schedule
+    """
+
+    schedules = {}
+
+    for file in sorted(os.listdir(directory)):
+
+        if not file.endswith(".json"):
+            continue
+
+        with open(os.path.join(directory, file)) as incoming:
+            definition = json.load(incoming)
+
+        schedule = Schedule(
+            cohort=definition["cohort"],
+            slots=definition["slots"],
+            description=definition.get("description", ""),
+        )
+
+        if schedule.cohort in schedules:
+            raise ValueError(f"Cohort {schedule.cohort} is defined more than once")
+
+        schedules[schedule.cohort] = schedule
+
+    if DEFAULT_COHORT not in schedules:
+        raise ValueError(f"No schedule defined for default cohort {DEFAULT_COHORT}")
+
+    return schedules
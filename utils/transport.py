@@ -0,0 +1,230 @@
+#!/bin/python3
+
+"""
+Text message transports
+
+Everything that sends or reads texts goes through a transport, which has
+two methods - send(to, from_, body, status_callback) returning the message
+SID, and stream(**filters) yielding message records shaped like Twilio's:
+
+    TwilioTransport     the real API, over one pooled keep-alive HTTP session
+    RecordingTransport  keeps sent texts in memory and never hits the network
+    SimulatedTransport  a RecordingTransport with network-like latency and
+                        failures, for throughput tuning and load tests offline
+"""
+
+import random, threading, time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+
+##########
+
+
+class TwilioTransport:
+    def __init__(
+        self,
+        account: str,
+        auth: str,
+        pool_size: int = 16,
+        timeout: float = 30,
+        retries: int = 2,
+    ):
+        """
+        Sends through the Twilio REST API
+
+        Every thread shares one HTTP session whose connection pool holds
+        pool_size keep-alive connections, so a distribution run pays for the
+        TLS handshake once per connection rather than once per text
+
+        Parameters
+            account: str | Twilio account SID
+            auth: str | Twilio auth token
+            pool_size: int | Connections kept open (>= sends in flight)
+            timeout: float | Seconds before a request is abandoned
+            retries: int | Retries for failed connections (not for sent requests)
+        """
+
+        # Deferred so the app can start without importing the Twilio library
+        from requests.adapters import HTTPAdapter
+        from twilio.http.http_client import TwilioHttpClient
+        from twilio.rest import Client
+
+        http = TwilioHttpClient(pool_connections=True, timeout=timeout)
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=retries
+        )
+        http.session.mount("https://", adapter)
+
+        self.client = Client(account, auth, http_client=http)
+
+    def send(self, to, from_, body, status_callback=None):
+        options = {"status_callback": status_callback} if status_callback else {}
+
+        message = self.client.messages.create(to=to, from_=from_, body=body, **options)
+
+        return message.sid
+
+    def stream(self, **filters):
+        return self.client.messages.stream(**filters)
+
+
+class TransportError(Exception):
+    """
+    Raised by SimulatedTransport for simulated failures
+    """
+
+
+class RecordingTransport:
+    def __init__(self):
+        """
+        In-memory transport: every send is recorded (newest last in .sent)
+        and stream() reads them back like the Twilio API would
+        """
+
+        self.lock = threading.Lock()
+        self.sent = []
+
+    def send(self, to, from_, body, status_callback=None):
+        with self.lock:
+            return self.record(
+                to=to, from_=from_, body=body, direction="outbound-api", status="sent"
+            ).sid
+
+    def record(self, to, from_, body, direction, status, when=None, error_code=None):
+        """
+        Adds a message to the history (callers hold self.lock)
+        """
+
+        when = when or datetime.now(timezone.utc)
+
+        message = SimpleNamespace(
+            sid=f"SM{len(self.sent):032d}",
+            to=to,
+            from_=from_,
+            body=body,
+            direction=direction,
+            status=status,
+            error_code=error_code,
+            date_created=when,
+            date_sent=when,
+        )
+
+        self.sent.append(message)
+
+        return message
+
+    def stream(
+        self,
+        limit=None,
+        to=None,
+        from_=None,
+        date_sent_after=None,
+        date_sent_before=None,
+        **options,
+    ):
+        """
+        Yields recorded messages newest first, filtered like the Twilio API
+        """
+
+        with self.lock:
+            history = list(reversed(self.sent))
+
+        returned = 0
+
+        for message in history:
+
+            if to is not None and message.to != to:
+                continue
+
+            if from_ is not None and message.from_ != from_:
+                continue
+
+            after, before = date_sent_after, date_sent_before
+
+            if after is not None and message.date_sent < utc(after):
+                continue
+
+            if before is not None and message.date_sent >= utc(before):
+                continue
+
+            yield message
+            returned += 1
+
+            if limit is not None and returned >= limit:
+                return
+
+
+class SimulatedTransport(RecordingTransport):
+    def __init__(
+        self,
+        latency: float = 0.05,
+        jitter: float = 0.02,
+        failure_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        """
+        Local stand-in for Twilio with simulated network latency and failures
+
+        Parameters
+            latency: float | Mean seconds per send
+            jitter: float | Random +/- seconds added to each send
+            failure_rate: float | Fraction of sends that raise TransportError
+            seed: int | Random seed, so failures are reproducible
+        """
+
+        super().__init__()
+
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.failed = 0
+
+    def send(self, to, from_, body, status_callback=None):
+        with self.lock:
+            delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+            fails = self.random.random() < self.failure_rate
+
+        # Sleeping releases the GIL, like waiting on a real HTTP response
+        time.sleep(max(delay, 0))
+
+        if fails:
+            with self.lock:
+                self.failed += 1
+
+            raise TransportError(f"Simulated failure sending to {to}")
+
+        return super().send(to, from_, body, status_callback)
+
+
+def utc(value):
+    """
+    Treats naive datetimes as UTC, the way the Twilio library does
+    """
+
+    return value if value.tzinfo is not None else value.replace(tzinfo=timezone.utc)
+
+
+def make_transport(kind: str, account=None, auth=None, pool_size=16, **options):
+    """
+    This function builds a transport by name
+
+    Parameters
+        kind: str | "twilio", "recording" or "simulated"
+        account: str | Twilio account SID (twilio only)
+        auth: str | Twilio auth token (twilio only)
+        pool_size: int | Keep-alive connections (twilio only)
+        options: Keyword arguments for the transport's constructor
+    """
+
+    if kind == "twilio":
+        return TwilioTransport(account, auth, pool_size=pool_size, **options)
+
+    if kind == "recording":
+        return RecordingTransport()
+
+    if kind == "simulated":
+        return SimulatedTransport(**options)
+
+    raise ValueError(f"Unknown text transport: {kind}")
@@ -0,0 +1,148 @@
+#!/bin/python3
+import atexit, queue, sqlite3, threading
+from time import monotonic, sleep
+from utils.connection import open_connection
+
+
+##########
+
+
+class BackgroundWriter:
+    def __init__(
+        self,
+        database_path: str,
+        batch_size: int = 200,
+        interval: float = 0.5,
+        retries: int = 5,
+        backoff: float = 0.5,
+    ):
+        """
+        Single background thread that owns all webhook writes to SQLite
+
+        Request handlers call submit() and return immediately; the writer
+        drains the queue and applies everything it has collected in one
+        transaction, so a burst of webhooks becomes a handful of commits
+
+        Parameters
+            database_path: str | Path to jm.db
+            batch_size: int | Most statements applied per transaction
+            interval: float | Seconds to wait for more work before committing
+            retries: int | Extra attempts for a batch that hits a locked database
+            backoff: float | Seconds before the first retry, doubling each time
+        """
+
+        self.database_path = database_path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+        # Don't lose queued webhooks when the worker shuts down cleanly
+        atexit.register(self.close)
+
+    def submit(self, sql: str, params: tuple):
+        """
+        Queues one parameterized statement; never blocks on the database
+        """
+
+        self.start()
+        self.queue.put((sql, params))
+
+    def start(self):
+        """
+        Starts the writer thread on first use
+        """
+
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+
+            self.thread = threading.Thread(
+                target=self.run, name="jm-db-writer", daemon=True
+            )
+            self.thread.start()
+
+    def close(self):
+        """
+        Flushes anything still queued and stops the writer thread
+        """
+
+        if self.thread is None:
+            return
+
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def run(self):
+        connection = open_connection(self.database_path)
+
+        try:
+            while True:
+                item = self.queue.get()
+
+                if item is None:
+                    return
+
+                batch = [item]
+                stop = False
+                deadline = monotonic() + self.interval
+
+                # Collect whatever else arrives before the deadline
+                while len(batch) < self.batch_size:
+                    try:
+                        item = self.queue.get(timeout=max(0, deadline - monotonic()))
+                    except queue.Empty:
+                        break
+
+                    if item is None:
+                        stop = True
+                        break
+
+                    batch.append(item)
+
+                self.apply(connection, batch)
+
+                if stop:
+                    return
+
+        finally:
+            connection.close()
+
+    def apply(self, connection, batch):
+        """
+        Applies a batch in one transaction, grouping identical statements
+        into executemany calls
+
+        A busy / locked database (e.g., a distribution run flushing contact
+        events) is retried with exponential backoff; a batch is only logged
+        and dropped once the retries run out, or for errors a retry can't fix
+        """
+
+        grouped = {}
+
+        for sql, params in batch:
+            grouped.setdefault(sql, []).append(params)
+
+        for attempt in range(self.retries + 1):
+            try:
+                with connection:
+                    for sql, rows in grouped.items():
+                        connection.executemany(sql, rows)
+
+                return
+
+            except sqlite3.OperationalError as e:
+                error = e
+
+                if attempt < self.retries:
+                    sleep(self.backoff * 2**attempt)
+
+            except sqlite3.Error as e:
+                error = e
+                break
+
+        print(f"\n** Background write of {len(batch)} rows failed: {error} **\n")